@@ -54,9 +54,7 @@ class Cube3Writer(QObject, MeshWriter):
             },
 
             # This array is used when parsing the g-code to skip lines
-            "skip_prefixes": [";", "G90", "G92", "M82", "M227 S128 P128"],
-            
-            "G_format": "{0} X{1:.3f} Y{2:.3f} Z{3:.4f}"
+            "skip_prefixes": [";", "G90", "G92", "M82", "M227 S128 P128"]
         }        
         
     @call_on_qt_thread
@@ -0,0 +1,126 @@
+####################################################################
+#  BlowfishECBWriter for the CubeproWriter plugin
+#
+#  A write-only file-like object which encrypts everything written to
+#  it with Blowfish in ECB mode before passing it on to the underlying
+#  stream. Only the trailing partial block and the current batch are
+#  held in memory, and the encrypted output is written in large writes.
+#  The start of the plaintext can be kept so that the header can be
+#  patched once the whole file has been written.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+from .blowfish import Blowfish
+
+
+class BlowfishECBWriter:
+    def __init__(self, stream, cipher: Blowfish, compatibility_mode: bool = False, batch_size: int = 1024 * 1024, write_size: int = 64 * 1024, encryptor = None, keep_prefix: int = 0) -> None:
+        # Data is encrypted once batch_size bytes have been collected. When an encryptor (a ParallelEncryptor)
+        # is given batches are passed to it, otherwise they are encrypted with the bulk functions of cipher. The first
+        # keep_prefix bytes of plaintext are kept for getPrefix().
+        self._stream = stream
+        self._cipher = cipher
+        self._compatibility_mode = compatibility_mode
+        self._batch_size = max(8, batch_size - batch_size % 8)
+        self._write_size = write_size
+        self._encryptor = encryptor
+
+        self._buffer = bytearray()
+        self._position = 0
+        self._keep_prefix = keep_prefix
+        self._prefix = bytearray()
+        self._closed = False
+
+    def writable(self) -> bool:
+        return True
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    ######################################################################
+    ##  Returns the number of plaintext bytes written so far
+    ######################################################################
+    def tell(self) -> int:
+        return self._position
+
+    ######################################################################
+    ##  Returns the start of the plaintext written so far, up to the
+    ##  keep_prefix bytes given when the writer was created
+    ######################################################################
+    def getPrefix(self) -> bytes:
+        return bytes(self._prefix)
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise ValueError("write to closed BlowfishECBWriter")
+
+        if len(self._prefix) < self._keep_prefix:
+            with memoryview(data) as view:
+                self._prefix += view.cast("B")[:self._keep_prefix - len(self._prefix)]
+
+        self._buffer += data
+        self._position += len(data)
+        if len(self._buffer) >= self._batch_size:
+            self._encryptBuffered(len(self._buffer) - len(self._buffer) % 8)
+        return len(data)
+
+    def writelines(self, lines) -> None:
+        for line in lines:
+            self.write(line)
+
+    ######################################################################
+    ##  Encrypts and writes out all complete blocks. The trailing partial
+    ##  block stays buffered until more data or close() completes it.
+    ######################################################################
+    def flush(self) -> None:
+        if self._closed:
+            return
+        self._encryptBuffered(len(self._buffer) - len(self._buffer) % 8)
+        flush = getattr(self._stream, "flush", None)
+        if flush is not None:
+            flush()
+
+    ######################################################################
+    ##  Pads the data to a whole number of blocks, using the number of
+    ##  padding bytes as the padding value, and writes out the rest of
+    ##  it. A full block of padding is added when the data is already
+    ##  block aligned. The underlying stream is left open.
+    ######################################################################
+    def close(self) -> None:
+        if self._closed:
+            return
+
+        padding = 8 - len(self._buffer) % 8
+        self._buffer += bytes([padding]) * padding
+        self._encryptBuffered(len(self._buffer))
+        self._closed = True
+
+    def __enter__(self) -> "BlowfishECBWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # Don't finish off the file if writing it failed
+        if exc_type is None:
+            self.close()
+
+    def _encryptBuffered(self, length: int) -> None:
+        if length <= 0:
+            return
+
+        with memoryview(self._buffer) as view:
+            data = view[:length]
+            if self._encryptor is not None:
+                self._encryptor.encryptToStream(self._cipher, data, self._stream, self._compatibility_mode, self._write_size)
+            else:
+                encrypted = memoryview(self._cipher.encrypt_blocks(data, self._compatibility_mode))
+                for start in range(0, len(encrypted), self._write_size):
+                    self._stream.write(encrypted[start:start + self._write_size])
+            data.release()
+
+        del self._buffer[:length]
@@ -0,0 +1,206 @@
+####################################################################
+#  CipherBackends for the CubeproWriter plugin
+#
+#  Registry of the bulk Blowfish ECB implementations. At plugin load
+#  the registered backends are tried from fastest to slowest and the
+#  first one that passes a known-answer test against the reference
+#  implementation in blowfish.py is used for all encryption.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import time
+import warnings
+
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from . import blowfish
+from .blowfish import Blowfish
+
+
+######################################################################
+##  Engines backed by native Blowfish implementations. These work on
+##  big endian words so compatibility mode swaps the byte order of
+##  every word before and after.
+######################################################################
+class CryptographyEngine:
+    def __init__(self, key: bytes) -> None:
+        from cryptography.hazmat.primitives.ciphers import Cipher, modes
+        try:
+            from cryptography.hazmat.decrepit.ciphers.algorithms import Blowfish as algorithm
+        except ImportError:
+            from cryptography.hazmat.primitives.ciphers.algorithms import Blowfish as algorithm
+
+        with warnings.catch_warnings():
+            # Blowfish is deprecated by cryptography but it's what the printers use
+            warnings.simplefilter("ignore")
+            self._cipher = Cipher(algorithm(key), modes.ECB())
+
+    def encrypt_blocks(self, data, compatibility_mode = False) -> bytes:
+        return self._process(self._cipher.encryptor(), data, compatibility_mode)
+
+    def decrypt_blocks(self, data, compatibility_mode = False) -> bytes:
+        return self._process(self._cipher.decryptor(), data, compatibility_mode)
+
+    @staticmethod
+    def _process(context, data, compatibility_mode: bool) -> bytes:
+        if compatibility_mode:
+            return blowfish.swap_words(context.update(blowfish.swap_words(data)) + context.finalize())
+        return context.update(data) + context.finalize()
+
+
+class PyCryptodomeEngine:
+    def __init__(self, key: bytes) -> None:
+        try:
+            from Cryptodome.Cipher import Blowfish as algorithm
+        except ImportError:
+            from Crypto.Cipher import Blowfish as algorithm
+
+        self._cipher = algorithm.new(key, algorithm.MODE_ECB)
+
+    def encrypt_blocks(self, data, compatibility_mode = False) -> bytes:
+        if compatibility_mode:
+            return blowfish.swap_words(self._cipher.encrypt(blowfish.swap_words(data)))
+        return self._cipher.encrypt(bytes(data))
+
+    def decrypt_blocks(self, data, compatibility_mode = False) -> bytes:
+        if compatibility_mode:
+            return blowfish.swap_words(self._cipher.decrypt(blowfish.swap_words(data)))
+        return self._cipher.decrypt(bytes(data))
+
+
+def _createNativeEngine(engine_type):
+    def factory(cipher: Blowfish):
+        # Native libraries derive their own key schedule so they need the key itself
+        if cipher.key is None:
+            raise RuntimeError("Cipher key is not available")
+        return engine_type(cipher.key)
+    return factory
+
+
+def _createNumpyEngine(cipher: Blowfish):
+    if blowfish.numpy is None:
+        raise ImportError("NumPy is not available")
+    return blowfish.NumpyEngine(cipher.p_boxes, cipher.s_boxes)
+
+
+def _createArrayEngine(cipher: Blowfish):
+    return blowfish.ArrayEngine(cipher.p_boxes, cipher.s_boxes)
+
+
+class CipherBackend(NamedTuple):
+    name: str
+    factory: Callable  # Blowfish -> engine with encrypt_blocks() and decrypt_blocks()
+
+
+class SelectedBackend(NamedTuple):
+    backend: CipherBackend
+    throughput: float  # MB/s measured on the self-test key
+
+
+class CipherBackendRegistry:
+    # Reference vector from Bruce Schneier's published test data, used to check the reference implementation itself
+    _reference_key = bytes(8)
+    _reference_plaintext = bytes(8)
+    _reference_ciphertext = bytes.fromhex("4ef997456198dd78")
+
+    # Candidates are compared with the reference implementation using one of the print file keys
+    _test_key = b"221BBakerMycroft"
+    _test_size = 4096
+    _benchmark_size = 64 * 1024
+
+    def __init__(self) -> None:
+        self._backends = []  # type: List[Tuple[int, CipherBackend]]
+        self._failures = []  # type: List[Tuple[str, str]]
+        self._selected = None  # type: Optional[SelectedBackend]
+
+    ######################################################################
+    ##  Registers a backend. Backends are tried in order of descending
+    ##  priority. The factory should raise ImportError when the library
+    ##  it needs isn't installed.
+    ######################################################################
+    def register(self, name: str, factory: Callable, priority: int) -> None:
+        self._backends.append((priority, CipherBackend(name, factory)))
+        self._backends.sort(key = lambda item: -item[0])
+
+    def getBackends(self) -> List[CipherBackend]:
+        return [backend for priority, backend in self._backends]
+
+    ######################################################################
+    ##  Returns (backend name, reason) for every backend rejected by the
+    ##  last call to select()
+    ######################################################################
+    def getFailures(self) -> List[Tuple[str, str]]:
+        return list(self._failures)
+
+    def getSelected(self) -> Optional[SelectedBackend]:
+        return self._selected
+
+    ######################################################################
+    ##  Picks the highest priority backend that passes the self-test and
+    ##  installs it as the engine factory of all Blowfish instances.
+    ##  Returns None, leaving the default engine in place, if none did.
+    ######################################################################
+    def select(self) -> Optional[SelectedBackend]:
+        self._failures = []
+        self._selected = None
+
+        reference = Blowfish(self._reference_key)
+        if reference.encrypt(self._reference_plaintext) != self._reference_ciphertext:
+            self._failures.append(("reference", "known-answer test failed"))
+            return None
+
+        for backend in self.getBackends():
+            try:
+                throughput = self.selfTest(backend)
+            except ImportError as e:
+                self._failures.append((backend.name, "not available: " + str(e)))
+                continue
+            except Exception as e:
+                self._failures.append((backend.name, "self-test error: " + repr(e)))
+                continue
+
+            if throughput is None:
+                self._failures.append((backend.name, "known-answer test failed"))
+                continue
+
+            self._selected = SelectedBackend(backend, throughput)
+            blowfish.set_engine_factory(backend.factory)
+            return self._selected
+
+        return None
+
+    ######################################################################
+    ##  Checks backend against the reference implementation in both byte
+    ##  orders. Returns its throughput in MB/s, or None on a mismatch.
+    ######################################################################
+    def selfTest(self, backend: CipherBackend) -> Optional[float]:
+        cipher = Blowfish(self._test_key)
+        engine = backend.factory(cipher)
+
+        plaintext = bytes(i * 7 & 0xFF for i in range(self._test_size))
+        for compatibility_mode in (True, False):
+            expected = b"".join(cipher.encrypt(plaintext[i:i + 8], compatibility_mode) for i in range(0, len(plaintext), 8))
+            if engine.encrypt_blocks(plaintext, compatibility_mode) != expected:
+                return None
+            if engine.decrypt_blocks(memoryview(expected), compatibility_mode) != plaintext:
+                return None
+
+        sample = bytes(self._benchmark_size)
+        start = time.perf_counter()
+        engine.encrypt_blocks(sample, True)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        return len(sample) / elapsed / 1e6
+
+
+def createDefaultRegistry() -> CipherBackendRegistry:
+    registry = CipherBackendRegistry()
+    registry.register("cryptography", _createNativeEngine(CryptographyEngine), 40)
+    registry.register("pycryptodome", _createNativeEngine(PyCryptodomeEngine), 30)
+    registry.register("numpy", _createNumpyEngine, 20)
+    registry.register("python", _createArrayEngine, 10)
+    return registry
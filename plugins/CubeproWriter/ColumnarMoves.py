@@ -0,0 +1,69 @@
+####################################################################
+#  ColumnarMoves for the CubeproWriter plugin
+#
+#  The moves of translated g-code kept as columns rather than as text,
+#  for the passes over the moves that need numbers instead of lines.
+#  MoveCodec appends the X, Y and Z the printer is at after each move,
+#  with every axis filled in, and the feedrate it runs at, each to its
+#  own array of doubles. The print time estimate takes the columns as
+#  NumPy arrays without parsing the g-code again or building a tuple
+#  for each move.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+from array import array
+from typing import Callable, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class MoveColumns:
+    def __init__(self) -> None:
+        self._x = array("d")
+        self._y = array("d")
+        self._z = array("d")
+        self._feedrates = array("d")
+
+    def __len__(self) -> int:
+        return len(self._feedrates)
+
+    ######################################################################
+    ##  Returns the append methods of the X, Y, Z and feedrate columns,
+    ##  for adding moves without a method call of this class for each.
+    ##  They stay valid after clear().
+    ######################################################################
+    def getAppenders(self) -> Tuple[Callable, Callable, Callable, Callable]:
+        return self._x.append, self._y.append, self._z.append, self._feedrates.append
+
+    ######################################################################
+    ##  Returns the end of each move as a row of X, Y and Z, a NumPy
+    ##  array when NumPy is available and a list of tuples otherwise
+    ######################################################################
+    def getPoints(self):
+        if numpy is not None:
+            return numpy.column_stack((self._x, self._y, self._z))
+        return list(zip(self._x, self._y, self._z))
+
+    ######################################################################
+    ##  Returns the feedrate of each move in mm/min, as getPoints() does
+    ######################################################################
+    def getFeedrates(self):
+        if numpy is not None:
+            return numpy.array(self._feedrates, dtype = numpy.float64)
+        return list(self._feedrates)
+
+    ######################################################################
+    ##  Removes every move, keeping the columns themselves
+    ######################################################################
+    def clear(self) -> None:
+        # The arrays are emptied in place so that the append methods handed out stay bound to them
+        for column in (self._x, self._y, self._z, self._feedrates):
+            del column[:]
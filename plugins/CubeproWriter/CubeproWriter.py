@@ -14,15 +14,17 @@
 #  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
 ####################################################################
 
+import os
 import sys
 
-from io import StringIO, BytesIO, BufferedIOBase
-from typing import cast, List, Optional, Dict
+from io import BufferedIOBase
+from typing import cast, Callable, List, Optional, Dict, Tuple
 
 from UM.i18n import i18nCatalog
 from UM.Message import Message
 from UM.Logger import Logger
 from UM.Mesh.MeshWriter import MeshWriter
+from UM.Resources import Resources
 
 from UM.Qt.Duration import DurationFormat
 from UM.PluginRegistry import PluginRegistry
@@ -31,12 +33,39 @@ from cura.CuraApplication import CuraApplication
 from cura.Utils.Threading import call_on_qt_thread
 from PyQt6.QtCore import QObject
 
-from .blowfish import Blowfish
+from .BlowfishECBWriter import BlowfishECBWriter
+from .CipherBackends import createDefaultRegistry
+from .ExportPipeline import ExportPipeline
+from .GCodeTranslator import GCodeLineSink, GCodeTranslationError, GCodeTranslator
+from .HeaderPatcher import HeaderPatcher
+from .KeyScheduleCache import KeyScheduleCache
+from .LayerCache import LayerCache
+from .MoveMerger import MoveMerger
+from .ParallelEncryptor import ParallelEncryptor
+from .ParallelTranslator import ParallelTranslator
+from .PreheatScheduler import PreheatScheduler
+from .RewriteStages import RewriteStageRunner
+from .SceneGCodeSource import SceneGCodeSource
+from . import TranslationRules
 
 catalog = i18nCatalog("cura")
 
 
 class CubeproWriter(QObject, MeshWriter):
+    _parallel_encryption_preference = "CubeproWriter/parallel_encryption"
+    _parallel_translation_preference = "CubeproWriter/parallel_translation"
+    _pipelined_export_preference = "CubeproWriter/pipelined_export"
+    _move_merging_preference = "CubeproWriter/move_merging"
+    _move_merging_tolerance_preference = "CubeproWriter/move_merging_tolerance"
+    _redundant_command_removal_preference = "CubeproWriter/redundant_command_removal"
+    _toolchange_preheat_preference = "CubeproWriter/toolchange_preheat"
+    _toolchange_preheat_time_preference = "CubeproWriter/toolchange_preheat_time"
+    _layer_cache_preference = "CubeproWriter/layer_cache"
+    _header_patching_preference = "CubeproWriter/header_patching"
+
+    # The metadata entry of the printer definitions holding the limits the print time is estimated with
+    _machine_limits_key = "cube_machine_limits"
+
     def __init__(self) -> None:
         super().__init__(add_to_recent_files = False)
         self._version = "0.2.5"
@@ -45,7 +74,61 @@ class CubeproWriter(QObject, MeshWriter):
         self._encryption_key = b""
         self._material_map = {}
         self._skip_prefixes = []
-        self._G_format = ""
+
+        # Derived Blowfish key schedules are reused between exports and Cura sessions
+        self._key_schedule_cache = KeyScheduleCache(os.path.join(Resources.getCacheStoragePath(), "CubeproWriter"))
+
+        # Very large print files can be encrypted on all cores. This is off by default since the worker
+        # processes import the main script of the running application again.
+        self._parallel_encryptor = ParallelEncryptor()
+        CuraApplication.getInstance().getPreferences().addPreference(self._parallel_encryption_preference, False)
+
+        # Large jobs can be translated a few layers at a time on all cores, with the same caveat as the parallel
+        # encryption
+        self._parallel_translator = ParallelTranslator()
+        CuraApplication.getInstance().getPreferences().addPreference(self._parallel_translation_preference, False)
+
+        # The stages of an export can run in their own threads. The GIL limits how much they overlap and the stream is
+        # then written from another thread, so it's off by default.
+        CuraApplication.getInstance().getPreferences().addPreference(self._pipelined_export_preference, False)
+        self._pipeline_statistics = []  # type: List[Dict]
+
+        # Runs of moves along a straight line can be merged into one move, within a tolerance given as a fraction of
+        # the nozzle size. This changes the moves the printer makes slightly, so it's off by default.
+        CuraApplication.getInstance().getPreferences().addPreference(self._move_merging_preference, False)
+        CuraApplication.getInstance().getPreferences().addPreference(self._move_merging_tolerance_preference, 0.05)
+
+        # Fan and extruder temperature commands which repeat what is already set can be left out, along with the pause
+        # after each fan speed change. This changes the print files, so it's off by default.
+        CuraApplication.getInstance().getPreferences().addPreference(self._redundant_command_removal_preference, False)
+
+        # The next extruder can be heated up to this many seconds ahead of a tool change, so that the printer doesn't
+        # stand still waiting for it
+        CuraApplication.getInstance().getPreferences().addPreference(self._toolchange_preheat_preference, False)
+        CuraApplication.getInstance().getPreferences().addPreference(self._toolchange_preheat_time_preference, 60)
+
+        # The translation of each layer can be kept until the next export, which then only translates the layers that
+        # changed, such as after changing a setting and slicing again. This holds on to memory between exports, so
+        # it's off by default, and the cache is emptied when the machine changes. It isn't used by the parallel
+        # translator, which translates many layers at a time.
+        self._layer_cache = LayerCache()
+        CuraApplication.getInstance().getPreferences().addPreference(self._layer_cache_preference, False)
+
+        # The layer count, filament lengths and print time can be counted from the g-code and patched into the header
+        # once the export is done. The fields are then written zero padded to a fixed width, which hasn't been tried on
+        # the printers yet, so it's off by default.
+        CuraApplication.getInstance().getPreferences().addPreference(self._header_patching_preference, False)
+
+        self._selectCipherBackend()
+
+        # The translation rules of the active machine's definition are compiled whenever the machine changes, and used
+        # for every export until it changes again
+        self._translation_rules = TranslationRules.compileRules(None)
+        self._translation_rules_id = None
+        CuraApplication.getInstance().globalContainerStackChanged.connect(self._onGlobalContainerStackChanged)
+
+        # Other plugins can add stages that rewrite the g-code as it is exported, see RewriteStages
+        self._rewrite_stage_factories = []  # type: List[Callable]
 
         self._params = {
             "plugin_name": self._plugin_name,
@@ -55,29 +138,40 @@ class CubeproWriter(QObject, MeshWriter):
             "material_map": {
                 "PLA": {
                     "material_code": "209",     # PLA Black
-                    "gcode_M240_param": 2000
                 },
                 "ABS": {
                     "material_code": "259",     # ABS Black
-                    "gcode_M240_param": 1400
                 },
                 "Nylon": {
                     "material_code": "403",     # Nylon natural
-                    "gcode_M240_param": 1200
                 },
                 "PETG": {
                     "material_code": "259",     # PETG - use ABS Black **EXPERIMENTAL**
-                    "gcode_M240_param": 1400
                 }
             },
 
             # This array is used when parsing the g-code to skip lines
-            "skip_prefixes": [";", "G90", "G92", "M82", "M227 S128 P128"],
-            
-            "G_format": "{0} X{1:.3f} Y{2:.3f} Z{3:.4f}"
+            "skip_prefixes": [";", "G90", "G92", "M82", "M227 S128 P128"]
         }
 
   
+    ######################################################################
+    ##  Picks the fastest Blowfish implementation that passes its self-test
+    ######################################################################
+    def _selectCipherBackend(self) -> None:
+        registry = createDefaultRegistry()
+        selected = registry.select()
+
+        for name, reason in registry.getFailures():
+            Logger.log("d" if reason.startswith("not available") else "w", self._plugin_name + " - Cipher backend " + name + " rejected: " + reason)
+
+        if selected is None:
+            Logger.log("e", self._plugin_name + " - No cipher backend passed its self-test, using the built-in default.")
+            return
+
+        level = "w" if selected.backend.name == "python" else "i"
+        Logger.log(level, self._plugin_name + " - Using " + selected.backend.name + " cipher backend ({0:.1f} MB/s).".format(selected.throughput))
+
     ######################################################################
     ##  Used to set/change parameters when called by another plugin
     ######################################################################
@@ -94,10 +188,26 @@ class CubeproWriter(QObject, MeshWriter):
         param = params.get("skip_prefixes")
         if param is not None:
             self._skip_prefixes = param
-        param = params.get("G_format")
-        if param is not None:
-            self._G_format = param
 
+    ######################################################################
+    ##  Adds a stage that rewrites the g-code of every export from now on.
+    ##  stage_factory is called at the start of each export to create the
+    ##  stage, usually a subclass of RewriteStages.RewriteStage. Stages
+    ##  run in the order they were added.
+    ######################################################################
+    def addRewriteStage(self, stage_factory: Callable) -> None:
+        self._rewrite_stage_factories.append(stage_factory)
+
+    def removeRewriteStage(self, stage_factory: Callable) -> None:
+        if stage_factory in self._rewrite_stage_factories:
+            self._rewrite_stage_factories.remove(stage_factory)
+
+    ######################################################################
+    ##  Returns the queue depths and timings of each stage of the last
+    ##  pipelined export, as returned by ExportPipeline.getStatistics()
+    ######################################################################
+    def getPipelineStatistics(self) -> List[Dict]:
+        return self._pipeline_statistics
 
     ######################################################################
     ##  Called to output the file
@@ -131,231 +241,284 @@ class CubeproWriter(QObject, MeshWriter):
             Logger.log("e", error_message)
             return False
 
-        # Setup constants
-        _print_time_correction_factor = 2.0
-        _newline = "\r\n"
-        
-        # The GCodeWriter plugin is always available since it is in the "required" list of plugins.
-        gcode_writer = PluginRegistry.getInstance().getPluginObject("GCodeWriter")
-
-        if gcode_writer is None:
-            error_message = self._plugin_name + " - Could not load GCodeWriter plugin. Try to re-enable the plugin."
-            Logger.log("e", error_message)
-            self.setInformation(catalog.i18nc("@error:load", error_message))
-            return False
-        
         Logger.log("i", self._plugin_name + " - Writing started.")
         Logger.log("i", self._plugin_name + " - Fetching Cura's g-code...")
-        gcode_writer = cast(MeshWriter, gcode_writer)
 
-        gcode_in = StringIO()
-        success = gcode_writer.write(gcode_in, None)
-        
-        # Getting the g-code failed so return with error
-        if not success:
-            self.setInformation(gcode_writer.getInformation())
-            return False
+        # Cura's g-code is read layer by layer from the scene. GCodeWriter, which writes the same g-code followed by the
+        # serialized profile, is only used when the scene doesn't hold any.
+        gcode_writer = SceneGCodeSource.forActiveBuildPlate()
+        if gcode_writer is None:
+            # The GCodeWriter plugin is always available since it is in the "required" list of plugins.
+            gcode_writer = PluginRegistry.getInstance().getPluginObject("GCodeWriter")
 
-        gcode_in.seek(0)
-        gcode_out = BytesIO()
-       
-        Logger.log("i", self._plugin_name + " - Processing g-code...")
-        
-        initial_extruder = 1
-        active_extruder = 1
-        previous_extruder = -1
-        
-        application = CuraApplication.getInstance()
-        global_stack = application.getMachineManager().activeMachine
-        extruders = application.getExtruderManager().getUsedExtruderStacks()
-        
-        print_time_mins = round(float(application.getPrintInformation().currentPrintTime.getDisplayString(DurationFormat.Format.Seconds)) / 60 * _print_time_correction_factor)
-        
-        header_found = False
-        command_buffer = ""
-        
-        G_xpos = float(0)
-        G_ypos = float(0)
-        G_zpos = float(5)   # initial Z pos is 5mm above bed to avoid accidental collision between bed and printhead
+            if gcode_writer is None:
+                error_message = self._plugin_name + " - Could not load GCodeWriter plugin. Try to re-enable the plugin."
+                Logger.log("e", error_message)
+                self.setInformation(catalog.i18nc("@error:load", error_message))
+                return False
 
-        G_format = self._G_format
-        
-        G_feedrate = 0
-        G_feedrate_present = False
-        
-        # The Cube 1 and Cube 2 printers don't seem to support the P paramater on M104 set extruder temp 
-        # commands, so we need to handle this condition differently in the M104 rewriter routine
-        M104_P_support = self._plugin_name != "CubeWriter"
+            gcode_writer = cast(MeshWriter, gcode_writer)
 
-        for line in gcode_in:
-            line = line.strip()
-        
-            # Skip unwanted lines
-            line_skipped = False
-            for prefix in self._skip_prefixes:
-                if line.startswith(prefix):
-                    line_skipped = True
-                    continue
-                    
-            # Skip blank lines too
-            if line_skipped or (not line):
-                continue
-            
-            # Check for g-code header information and substitute in known values
-            if line[0] == "^":
-                # This is usually the first line from machine_gcode_start begins
-                if line.startswith("^Firmware"):
-                    header_found = True
-                    
-                # This is usually the last line from machine_gcode_start indicating end of the gcode header
-                # Once this is found any pre-header commands that may have been stored away can be output
-                elif line == "^InitComplete":
-                    line = command_buffer + line
-                
-                elif line.startswith("^MaterialCode"):
-                    extruder_num = int(line[14])
-                    if extruder_num <= len(extruders) and extruders[extruder_num - 1].isEnabled:
-                        material_mapped = self._material_map.get(extruders[extruder_num - 1].material.getMetaDataEntry("material"))
-                        if material_mapped is None:
-                            error_message = self._plugin_name + " - Unsupported filament type selected."
-                            Logger.log("e", error_message)
-                            self.setInformation(catalog.i18nc("@error", error_message))
-                            return False
-                        
-                        line = f"^MaterialCodeE{extruder_num}:{material_mapped['material_code']}"
-
-                elif line.startswith("^MaterialLength"):
-                    extruder_num = int(line[16])
-                    if extruder_num <= len(extruders) and extruders[extruder_num - 1].isEnabled:
-                        line = f"^MaterialLengthE{extruder_num}:1" # The printer doesn't actually need to know how much
-
-                elif line.startswith("^Time"):
-                    line = f"^Time:{print_time_mins}"
-            
-            # T<int> sets active extruder.  CubePro does not use this as there are separate g-code commands for each extruder.
-            # However we need to store it away so that subsequent extruder specific commands can specify the active extruder.
-            elif line[0] == "T" and len(line) == 2:
-                if previous_extruder == -1:
-                    initial_extruder = int(line[1:]) + 1
-                    
-                previous_extruder = active_extruder
-                active_extruder = int(line[1:]) + 1
-                continue # skip this line
-            
-            # M240 command is used in the init g-code but it is not properly defined. It seems to be used on CubePro and Cube3
-            # but the parameters are different. Cube3 params are X<int> Y<int> S<int>. CubePro params are S<int> however the
-            # values are much higher on CubePro than on Cube3.
-            # Different materials seem to use different values so we'll try to match it based on material in Extruder 1
-            elif line.startswith("M240 S"):
-                gcode_M240_param = self._material_map[extruders[0].material.getMetaDataEntry("material")].get("gcode_M240_param")
-                if gcode_M240_param is not None:
-                    line = "M240 S" + str(gcode_M240_param)
-                
-            # M104 and M109 sets extruder temperature, with M109 triggering a pause until desired temperature is reached.
-            # An optional paramater T<int> specifies an extruder number, and if omitted the active extruder will be used.
-            # CubePro sets extruder temperature using M104, M204, and M304 for each extruder respectively and each command has 
-            # an optional P1 parameter which if omitted will trigger a pause until desired temperature is reached.
-            elif line.startswith("M104") or line.startswith("M109"):
-                extruder_temp = 0
-                extruder_num = active_extruder
-                wait_for_temp = line[3] == "9" # M109 = wait for temp
-                
-                gcode_args = line.split(" ")
-                for gcode_arg in gcode_args:
-                    if gcode_arg[0] == "S":                                   
-                        extruder_temp = round(float(gcode_arg[1:]))
-                    elif gcode_arg[0] == "T":
-                        extruder_num = int(gcode_arg[1]) + 1
-                    elif gcode_arg[0] == "P":
-                        wait_for_temp = gcode_arg[1] == "0"
-
-                line = f"M{extruder_num}04 S{extruder_temp:d}"
-                
-                if wait_for_temp:
-                    if not M104_P_support:
-                        line += f"{_newline}G4 P40" # P unsupported so just add a pause with G4
-                else:
-                    if M104_P_support:
-                        line += " P1"
-            
-            # M106 sets fan speed with S<int> parameter which has a range of 0-255. CubePro uses a P<int> parameter with a range 
-            # of 0-100. This converts to CubePro format M106 or change to M107 command (turn fan off) instead if fan speed is 0.
-            elif line.startswith("M106 S"):
-                fan_speed = round(float(line[6:]) / 2.55)
-                if fan_speed == 0:
-                    line = "M107"
-                else:
-                    line = f"M106 P{(fan_speed)}{_newline}G4 P2"
-            
-            # M141 and M191 sets chamber temperature, with M191 triggering a pause until desired temperature is reached.
-            # CubePro uses M404 with optional P1 paramater which if omitted will trigger a pause until desired temperature
-            # is reached.
-            elif line.startswith("M141") or line.startswith("191"):
-                # if P parameter is present then this line is probably from start/end gcode so strip out P0 and leave P1 alone
-                if "P0" in line:
-                    line = line[:-3]
-                elif "P1" not in line:
-                    build_volume_temperature = int(line[6:])
-                    add_P1 = (line[2] == "4") # if this is M141 then add P1
-                    line = f"M404 S{build_volume_temperature}"
-                    if add_P1: 
-                        line += " P1"
-                        
-            # Some printers seem to _really_ not like G moves that don't have X Y and Z coords so we'll capture each coord
-            # with each move and rewrite the G move to make sure all coords are included
-            elif line[0] == "G" and (line[1] == "0" or line[1] == "1"):
-                G_feedrate_present = False
-                gcode_args = line.split(" ")
-                for gcode_arg in gcode_args:
-                    if gcode_arg[0] == "X":
-                        G_xpos = float(gcode_arg[1:])
-                    elif gcode_arg[0] == "Y":
-                        G_ypos = float(gcode_arg[1:])
-                    elif gcode_arg[0] == "Z":
-                        G_zpos = float(gcode_arg[1:])
-                    elif gcode_arg[0] == "F":
-                        G_feedrate = float(gcode_arg[1:])
-                        G_feedrate_present = True
-                line = G_format.format(gcode_args[0], G_xpos, G_ypos, G_zpos)
-                if G_feedrate_present:
-                    line += " F{0:.1f}".format(G_feedrate)
-            
-            # Cura sometimes throws extruder heat and fan commands in before the g-code start block and this will cause the
-            # "Invalid Format" error when read by the printer, so we'll just store them away until after the header has
-            # been written to the output stream
-            if header_found:
-                gcode_out.write((line + _newline).encode("utf-8"))
+        Logger.log("i", self._plugin_name + " - Processing and encrypting g-code...")
+
+        # The g-code is translated, encoded and encrypted line by line as it is written out, so the job is
+        # never held in memory as a whole. The output is encrypted with blowfish as it is written. Batches are made
+        # large enough for the parallel encryptor to use all cores when it is able to.
+        preferences = CuraApplication.getInstance().getPreferences()
+
+        # Where the print file starts in stream, if the header is to be patched afterwards and can be
+        start = None
+        if preferences.getValue(self._header_patching_preference):
+            try:
+                start = stream.tell() if stream.seekable() else None
+            except (AttributeError, OSError):
+                start = None
+            if start is None:
+                Logger.log("w", self._plugin_name + " - Can't seek in the output stream, leaving the layer count, material lengths and print time as Cura gave them.")
+
+        # Translating, encrypting and writing to disk can each run in their own thread, connected by bounded queues,
+        # so that they overlap with each other and with fetching the g-code
+        pipeline = ExportPipeline() if preferences.getValue(self._pipelined_export_preference) else None
+        gcode_stream = pipeline.addStage("write", stream, close_target = False) if pipeline is not None else stream
+
+        cipher = self._key_schedule_cache.getCipher(self._encryption_key)
+        self._parallel_encryptor.setEnabled(bool(preferences.getValue(self._parallel_encryption_preference)))
+        if self._parallel_encryptor.isSupported():
+            gcode_out = BlowfishECBWriter(gcode_stream, cipher, True, batch_size = self._parallel_encryptor.getThreshold(), encryptor = self._parallel_encryptor, keep_prefix = HeaderPatcher.header_prefix_size)
+        else:
+            gcode_out = BlowfishECBWriter(gcode_stream, cipher, True, keep_prefix = HeaderPatcher.header_prefix_size)
+        gcode_encrypt = pipeline.addStage("encrypt", gcode_out) if pipeline is not None else gcode_out
+
+        # Rewrite stages get the translated g-code first, split into layers at markers the translator keeps for them
+        rewrite_stages = [stage_factory() for stage_factory in self._rewrite_stage_factories]
+        translator = self._createTranslator(layer_markers = bool(rewrite_stages), reserve_header_fields = start is not None)
+        stage_runner = RewriteStageRunner(rewrite_stages, self._plugin_name, GCodeTranslator.newline) if rewrite_stages else None
+        move_merger = self._createMoveMerger()
+        preheat_scheduler = self._createPreheatScheduler(translator)
+        passes = [output_pass for output_pass in (stage_runner, move_merger, preheat_scheduler) if output_pass is not None]
+        self._parallel_translator.setEnabled(bool(preferences.getValue(self._parallel_translation_preference)))
+        layer_cache = None
+        if not preferences.getValue(self._layer_cache_preference):
+            self._layer_cache.clear()
+        if self._parallel_translator.isSupported():
+            gcode_sink = GCodeLineSink(translator, gcode_encrypt, self._parallel_translator, passes = passes)
+        elif preferences.getValue(self._layer_cache_preference):
+            layer_cache = self._layer_cache
+            layer_cache.start(translator.getSettings())
+            gcode_sink = GCodeLineSink(translator, gcode_encrypt, passes = passes, layer_cache = layer_cache)
+        else:
+            gcode_sink = GCodeLineSink(translator, gcode_encrypt, passes = passes)
+        gcode_in = pipeline.addStage("translate", gcode_sink) if pipeline is not None else gcode_sink
+
+        try:
+            success = gcode_writer.write(gcode_in, None)
+
+            # Getting the g-code failed so return with error
+            if not success:
+                self.setInformation(gcode_writer.getInformation())
+                return False
+
+            # Translate the last line and pad and encrypt the final block
+            if pipeline is not None:
+                pipeline.close()
             else:
-                command_buffer += line + _newline
-        
-        # If no header found throw an error
-        if not header_found:
-            error_message = self._plugin_name + " - No g-code header found. Has the machine start gcode been edited?"
+                gcode_in.close()
+                gcode_out.close()
+
+        except GCodeTranslationError as e:
+            error_message = str(e)
             Logger.log("e", error_message)
             self.setInformation(catalog.i18nc("@error", error_message))
             return False
-        
-        # Encrypt gcode with blowfish and write to stream
-        Logger.log("i", self._plugin_name + " - Encrypting with BlowFish cipher...")
-        cipher = Blowfish(self._encryption_key)
-
-        gcode_out.seek(0)
-        padding = 0
-        do_loop = True
-
-        while do_loop:
-            chunk = gcode_out.read(8)
-            chunk_len = len(chunk)
-            if chunk_len < 8:
-                padding = 8 - chunk_len
-                chunk = chunk.ljust(8, bytes([padding]))
-                do_loop = False
-                # Exit loop after write
-                
-            stream.write(cipher.encrypt(chunk, True))
+
+        finally:
+            if pipeline is not None:
+                pipeline.abort()
+            self._parallel_translator.stop()
+            self._parallel_encryptor.stop()
+
+        if layer_cache is not None:
+            layer_cache.finish()
+            Logger.log("d", self._plugin_name + " - Took %d layers from the layer cache and translated %d." % layer_cache.getStatistics())
+
+        # The layer count, filament lengths and print time are only known now, so patch them into the header
+        self._patchHeader(stream, start, cipher, gcode_out.getPrefix(), translator.getHeaderFields())
+
+        if move_merger is not None:
+            Logger.log("d", self._plugin_name + " - Merged %d moves into %d." % move_merger.getMoveCounts())
+        if preheat_scheduler is not None:
+            Logger.log("d", self._plugin_name + " - Added %d tool change preheats, taking about %.0fs off the waits." % preheat_scheduler.getStatistics())
+
+        if pipeline is not None:
+            self._pipeline_statistics = pipeline.getStatistics()
+            for statistics in self._pipeline_statistics:
+                Logger.log("d", self._plugin_name + " - %(stage)s stage: %(items)d items, %(size)d bytes, busy %(busy_time).3fs, blocked %(blocked_time).3fs, max queue depth %(max_depth)d" % statistics)
 
         Logger.log("i", self._plugin_name + " - Writing completed successfully.")
-        
-        return True            
-    
-    
\ No newline at end of file
+
+        return True
+
+    ######################################################################
+    ##  Writes the real values of the header fields the translator left
+    ##  placeholders for into the print file written to stream from
+    ##  start, re-encrypting only the blocks that change
+    ######################################################################
+    def _patchHeader(self, stream, start: Optional[int], cipher, prefix: bytes, fields: Dict[str, str]) -> None:
+        if not fields or start is None:
+            return
+
+        try:
+            blocks = HeaderPatcher(cipher).patchStream(stream, start, prefix, fields)
+        except (OSError, ValueError, KeyError) as e:
+            Logger.log("w", self._plugin_name + " - Could not patch the header: " + str(e))
+            return
+
+        Logger.log("d", self._plugin_name + " - Patched " + ", ".join(name + ":" + str(int(value)) for name, value in sorted(fields.items())) + " into the header (%d blocks)." % blocks)
+
+    ######################################################################
+    ##  Creates a translator for Cura's g-code set up for the active
+    ##  machine, its extruders and the current print, keeping the layer
+    ##  markers in its output with layer_markers and leaving placeholders
+    ##  in the header to be patched with reserve_header_fields. The print
+    ##  time is only estimated when it's going to be patched in.
+    ######################################################################
+    def _createTranslator(self, layer_markers: bool = False, reserve_header_fields: bool = False) -> GCodeTranslator:
+        # Setup constants
+        _print_time_correction_factor = 2.0
+
+        application = CuraApplication.getInstance()
+        extruders = application.getExtruderManager().getUsedExtruderStacks()
+
+        # Cura's estimate is only written when the print time can't be estimated from the translated g-code
+        print_time_mins = round(float(application.getPrintInformation().currentPrintTime.getDisplayString(DurationFormat.Format.Seconds)) / 60 * _print_time_correction_factor)
+
+        return GCodeTranslator(
+            self._plugin_name,
+            self._material_map,
+            self._skip_prefixes,
+            [extruder.material.getMetaDataEntry("material") for extruder in extruders],
+            [extruder.isEnabled for extruder in extruders],
+            print_time_mins,
+            machine_limits = self._getMachineLimits() if reserve_header_fields else None,
+            drop_redundant = bool(application.getPreferences().getValue(self._redundant_command_removal_preference)),
+            heating_rates = self._getHeatingRates(),
+            rules = self._getTranslationRules(),
+            layer_markers = layer_markers,
+            reserve_header_fields = reserve_header_fields
+        )
+
+    def _onGlobalContainerStackChanged(self) -> None:
+        self._layer_cache.clear()
+        self._getTranslationRules()
+
+    ######################################################################
+    ##  Returns the plan compiled from the translation rules of the
+    ##  active machine's definition, compiling it when the machine has
+    ##  changed since the last time
+    ######################################################################
+    def _getTranslationRules(self) -> Dict:
+        global_stack = CuraApplication.getInstance().getGlobalContainerStack()
+        if global_stack is None:
+            return TranslationRules.compileRules(None)
+
+        definition = global_stack.definition
+        if definition.getId() != self._translation_rules_id:
+            self._translation_rules_id = definition.getId()
+            try:
+                self._translation_rules = TranslationRules.compileRules(definition.getMetaDataEntry(TranslationRules.metadata_key))
+            except ValueError as e:
+                Logger.log("w", self._plugin_name + " - The translation rules of " + definition.getId() + " can't be used: " + str(e))
+                self._translation_rules = TranslationRules.compileRules(None)
+        return self._translation_rules
+
+    ######################################################################
+    ##  Returns how fast the extruders of the active machine heat up and
+    ##  cool down in degrees C/s, from the machine limits of its
+    ##  definition
+    ######################################################################
+    def _getHeatingRates(self) -> Optional[Tuple[float, float]]:
+        limits = self._getMachineLimitsEntry()
+        try:
+            heating_rates = (float(limits["heat_up_speed"]), float(limits["cool_down_speed"]))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        if any(rate <= 0 for rate in heating_rates):
+            return None
+        return heating_rates
+
+    ######################################################################
+    ##  Creates a move merger if merging is turned on, with a tolerance
+    ##  scaled to the nozzle size of the active machine
+    ######################################################################
+    def _createMoveMerger(self) -> Optional[MoveMerger]:
+        preferences = CuraApplication.getInstance().getPreferences()
+        if not preferences.getValue(self._move_merging_preference):
+            return None
+
+        global_stack = CuraApplication.getInstance().getGlobalContainerStack()
+        nozzle_size = global_stack.getProperty("machine_nozzle_size", "value") if global_stack is not None else None
+        try:
+            tolerance = float(nozzle_size) * float(preferences.getValue(self._move_merging_tolerance_preference))
+        except (TypeError, ValueError):
+            tolerance = 0.0
+
+        if tolerance <= 0:
+            Logger.log("w", self._plugin_name + " - The machine has no usable nozzle size or merging tolerance, leaving the moves as they are.")
+            return None
+        return MoveMerger(tolerance, GCodeTranslator.newline)
+
+    ######################################################################
+    ##  Creates a preheat scheduler if tool change preheating is turned
+    ##  on and the printer can heat an extruder up without waiting
+    ######################################################################
+    def _createPreheatScheduler(self, translator: GCodeTranslator) -> Optional[PreheatScheduler]:
+        preferences = CuraApplication.getInstance().getPreferences()
+        if not preferences.getValue(self._toolchange_preheat_preference) or not translator.canSetTemperatureWithoutWaiting():
+            return None
+
+        heating_rates = self._getHeatingRates()
+        heat_up_speed = heating_rates[0] if heating_rates is not None else 0.0
+        try:
+            preheat_time = float(preferences.getValue(self._toolchange_preheat_time_preference))
+        except (TypeError, ValueError):
+            preheat_time = 0.0
+
+        if preheat_time <= 0 or heat_up_speed <= 0:
+            Logger.log("w", self._plugin_name + " - The machine has no usable heat up speed or preheat time, leaving the tool changes as they are.")
+            return None
+        return PreheatScheduler(preheat_time, heat_up_speed, GCodeTranslator.newline)
+
+    ######################################################################
+    ##  Returns the feedrate, acceleration and heating limits of the
+    ##  active machine for the print time estimate, from its definition
+    ######################################################################
+    def _getMachineLimits(self) -> Optional[Dict]:
+        limits = self._getMachineLimitsEntry()
+        try:
+            limits = {
+                "max_feedrate": [float(value) for value in limits["max_feedrate"]],
+                "max_acceleration": [float(value) for value in limits["max_acceleration"]],
+                "acceleration": float(limits["acceleration"]),
+                "jerk": float(limits["jerk"]),
+                "heat_up_speed": float(limits["heat_up_speed"]),
+                "cool_down_speed": float(limits["cool_down_speed"])
+            }
+        except (KeyError, TypeError, ValueError):
+            limits = None
+
+        # Leave the estimate out rather than guess at a limit that isn't set or can't be used
+        if limits is None or len(limits["max_feedrate"]) != 3 or len(limits["max_acceleration"]) != 3 or limits["jerk"] < 0 \
+                or any(value <= 0 for value in limits["max_feedrate"] + limits["max_acceleration"] + [limits["acceleration"], limits["heat_up_speed"], limits["cool_down_speed"]]):
+            Logger.log("w", self._plugin_name + " - The machine has no usable feedrate, acceleration or heating limits, using Cura's print time estimate.")
+            return None
+        return limits
+
+    # The limits are kept in the cube_machine_limits metadata entry of the definitions rather than in Cura's machine
+    # settings, which CuraEngine slices with. They are estimates of the printers' firmware limits.
+    def _getMachineLimitsEntry(self) -> Dict:
+        global_stack = CuraApplication.getInstance().getGlobalContainerStack()
+        if global_stack is None:
+            return {}
+        limits = global_stack.definition.getMetaDataEntry(self._machine_limits_key)
+        return limits if isinstance(limits, dict) else {}
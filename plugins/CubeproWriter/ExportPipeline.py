@@ -0,0 +1,207 @@
+####################################################################
+#  ExportPipeline for the CubeproWriter plugin
+#
+#  Runs the stages of an export (fetching Cura's g-code, translating
+#  it, encrypting it and writing it out) at the same time, each stage
+#  in its own thread, connected by bounded queues. A stage is added in
+#  front of a write-only stream and is itself a write-only stream, so
+#  the stages are chained the same way the streams already are. When a
+#  downstream stage falls behind its queue fills up and the stage in
+#  front of it waits, so memory use stays bounded.
+#
+#  Python only runs one thread at a time, so the stages overlap where
+#  they wait on the disk or run outside the interpreter, such as
+#  writing to slow removable media or a cipher backend in C.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import queue
+import threading
+import time
+
+from typing import Dict, List, Optional
+
+# Tells a stage thread that no more data is coming
+_end_of_data = object()
+
+
+class PipelineStage:
+    def __init__(self, name: str, target, max_depth: int = 64, close_target: bool = True) -> None:
+        # Everything written to the stage is passed on to target.write() in the stage's thread. Closing the stage
+        # closes target too unless close_target is False.
+        self._name = name
+        self._target = target
+        self._close_target = close_target
+        self._queue = queue.Queue(maxsize = max_depth)
+
+        self._error = None  # type: Optional[BaseException]
+        self._aborted = False
+        self._closed = False
+
+        self._items = 0
+        self._size = 0
+        self._max_depth = 0
+        self._busy_time = 0.0
+        self._blocked_time = 0.0
+
+        self._thread = threading.Thread(target = self._run, name = "ExportPipeline " + name, daemon = True)
+        self._thread.start()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self._error is not None:
+            raise self._error
+        if self._closed:
+            raise ValueError("write to closed PipelineStage")
+
+        # The writer may reuse its buffer as soon as this returns, so queue a copy of anything mutable
+        item = data if isinstance(data, (str, bytes)) else bytes(data)
+
+        start = time.perf_counter()
+        self._queue.put(item)
+        self._blocked_time += time.perf_counter() - start
+
+        self._items += 1
+        self._size += len(item)
+        self._max_depth = max(self._max_depth, self._queue.qsize())
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    ######################################################################
+    ##  Waits for everything written so far to be passed on, then closes
+    ##  the target. Raises any error the target raised.
+    ######################################################################
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_end_of_data)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    ######################################################################
+    ##  Stops the stage without passing on what is still queued or
+    ##  closing the target, for when the export has failed. With wait
+    ##  False the stage only stops passing things on.
+    ######################################################################
+    def abort(self, wait: bool = True) -> None:
+        self._aborted = True
+        if not wait:
+            return
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_end_of_data)
+        self._thread.join()
+
+    ######################################################################
+    ##  Returns the number of items and bytes (or characters) passed
+    ##  through the stage, its current and largest queue depth, the time
+    ##  its thread spent in the target and the time writers spent waiting
+    ##  for room in the queue
+    ######################################################################
+    def getStatistics(self) -> Dict:
+        return {
+            "stage": self._name,
+            "items": self._items,
+            "size": self._size,
+            "depth": self._queue.qsize(),
+            "max_depth": self._max_depth,
+            "busy_time": self._busy_time,
+            "blocked_time": self._blocked_time
+        }
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _end_of_data:
+                break
+
+            # After an error keep taking items off the queue so that the writer doesn't wait forever
+            if self._aborted or self._error is not None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                self._target.write(item)
+            except BaseException as e:
+                self._error = e
+            self._busy_time += time.perf_counter() - start
+
+        if self._close_target and not self._aborted and self._error is None:
+            start = time.perf_counter()
+            try:
+                self._target.close()
+            except BaseException as e:
+                self._error = e
+            self._busy_time += time.perf_counter() - start
+
+
+class ExportPipeline:
+    def __init__(self, max_depth: int = 64) -> None:
+        self._max_depth = max_depth
+        self._stages = []  # type: List[PipelineStage]
+        self._start_time = time.perf_counter()
+        self._fetch_time = None  # type: Optional[float]
+
+    ######################################################################
+    ##  Returns a new stage in front of target. Stages are added starting
+    ##  from the end of the pipeline, the stream being written to.
+    ######################################################################
+    def addStage(self, name: str, target, close_target: bool = True) -> PipelineStage:
+        stage = PipelineStage(name, target, self._max_depth, close_target)
+        self._stages.append(stage)
+        return stage
+
+    ######################################################################
+    ##  Closes the stages from the front of the pipeline to the end, so
+    ##  that each has passed on everything before the next is closed.
+    ##  Raises the first error any stage ran into, after stopping the rest.
+    ######################################################################
+    def close(self) -> None:
+        self._fetch_time = time.perf_counter() - self._start_time
+        try:
+            for stage in reversed(self._stages):
+                stage.close()
+        except BaseException:
+            self.abort()
+            raise
+
+    ######################################################################
+    ##  Stops all stages without finishing the output
+    ######################################################################
+    def abort(self) -> None:
+        # Stop every stage first so that none of them waits on a queue which is still being worked through
+        for stage in self._stages:
+            stage.abort(wait = False)
+        for stage in reversed(self._stages):
+            stage.abort()
+
+    ######################################################################
+    ##  Returns the statistics of each stage from the front of the
+    ##  pipeline to the end, after a "fetch" entry for the time the
+    ##  caller spent producing the data rather than waiting on the queue
+    ##  of the first stage
+    ######################################################################
+    def getStatistics(self) -> List[Dict]:
+        stages = [stage.getStatistics() for stage in reversed(self._stages)]
+        elapsed = self._fetch_time if self._fetch_time is not None else time.perf_counter() - self._start_time
+        fetch = {
+            "stage": "fetch",
+            "items": stages[0]["items"] if stages else 0,
+            "size": stages[0]["size"] if stages else 0,
+            "depth": 0,
+            "max_depth": 0,
+            "busy_time": elapsed - (stages[0]["blocked_time"] if stages else 0.0),
+            "blocked_time": stages[0]["blocked_time"] if stages else 0.0
+        }
+        return [fetch] + stages
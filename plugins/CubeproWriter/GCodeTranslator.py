@@ -0,0 +1,760 @@
+####################################################################
+#  GCodeTranslator for the CubeproWriter plugin
+#
+#  Translates the g-code Cura produces to the dialect understood by
+#  the Cube printers. Lines are translated one at a time as they are
+#  produced so the whole job never has to be held in memory, and the
+#  translator doesn't depend on Cura so it can be used by the tools.
+#
+#  All Cube g-code is ASCII so the translation works on bytes, and the
+#  translated lines are collected in a bytearray ready for encryption
+#  instead of being encoded one at a time.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import math
+import re
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from . import ColumnarMoves, TranslationRules
+from .MoveCodec import MoveCodec
+from .PrintTimeEstimator import PrintTimeEstimator
+
+
+class GCodeTranslationError(Exception):
+    pass
+
+
+class GCodeTranslator:
+    newline = b"\r\n"
+
+    # Header fields that are only known once the whole job has been translated are written this wide, padded with
+    # leading zeros, so that they can be patched afterwards without moving anything after them. The value stays a plain
+    # decimal number rather than relying on the firmware to skip spaces around it.
+    header_field_width = 8
+
+    # Cura writes the extrusion rate for BFB printers as extruder motor RPM, assuming 4mm of filament per revolution
+    _bfb_mm_per_revolution = 4.0
+
+    # The Cube firmware takes the pause of G4 P<int> in seconds, going by the pauses added here
+    _dwell_units = 1.0
+
+    # Without the heating rates of the extruders, the printers without P support on M104 pause this long for each wait
+    _heat_wait_dwell = 40
+
+    # The extruders start out cold
+    _room_temperature = 20
+
+    # Finds the lines which are a tool change or set an extruder temperature once stripped
+    _scanned_line_finditer = re.compile(rb"^[ \t\r\x0b\x0c]*(T[0-9]|M10[49](?: [^\r\n]*)?)[ \t\r\x0b\x0c]*$", re.MULTILINE).finditer
+
+    def __init__(self, plugin_name: str, material_map: Dict, skip_prefixes: List[str], extruder_materials: List[Optional[str]], extruders_enabled: List[bool], print_time_mins: int, machine_limits: Optional[Dict] = None, drop_redundant: bool = False, heating_rates: Optional[Tuple[float, float]] = None, rules: Optional[Dict] = None, layer_markers: bool = False, reserve_header_fields: bool = False) -> None:
+        # extruder_materials and extruders_enabled describe the used extruders in order, the material being the
+        # "material" metadata entry of the extruder's material container. With machine_limits, the limits
+        # PrintTimeEstimator takes, ^Time is estimated from the g-code instead of being print_time_mins. With
+        # drop_redundant, fan and extruder temperature commands which don't change anything are left out. heating_rates
+        # are how fast the extruders heat up and cool down in degrees C/s, for the pause that waits for them on printers
+        # without P support on M104. rules is the plan compiled by TranslationRules.compileRules() from the rule table
+        # of the printer definition, TranslationRules.default_rules when not given. With layer_markers the ;LAYER:<int>
+        # line starting each layer is kept in the output even though it is skipped, for the rewrite stages to split the
+        # output into layers by. With reserve_header_fields the layer count, material lengths and print time are
+        # written zero padded to header_field_width, for getHeaderFields() to be patched in afterwards, rather than as
+        # Cura gave them.
+        self._settings = {
+            "plugin_name": plugin_name,
+            "material_map": material_map,
+            "skip_prefixes": skip_prefixes,
+            "extruder_materials": extruder_materials,
+            "extruders_enabled": extruders_enabled,
+            "print_time_mins": print_time_mins,
+            "machine_limits": machine_limits,
+            "drop_redundant": drop_redundant,
+            "heating_rates": heating_rates,
+            "rules": rules,
+            "layer_markers": layer_markers,
+            "reserve_header_fields": reserve_header_fields
+        }
+
+        self._plugin_name = plugin_name
+        self._material_map = material_map
+        self._skip_prefixes = tuple(prefix.encode("utf-8") for prefix in skip_prefixes)
+        self._extruder_materials = extruder_materials
+        self._extruders_enabled = extruders_enabled
+        self._print_time_mins = print_time_mins
+        self._layer_markers = layer_markers
+        self._reserve_header_fields = reserve_header_fields
+
+        # The rules of the printer, which the translation depends on
+        rules = rules if rules is not None else TranslationRules.default_rules
+        G_format = rules["G_format"]
+
+        # The Cube 1 and Cube 2 printers don't seem to support the P paramater on M104 set extruder temp
+        # commands, so we need to handle this condition differently in the M104 rewriter routine
+        self._M104_P_support = rules["M104_P_support"]
+
+        # M240 is rewritten with a parameter which depends on the material in extruder 1, if there is one for it
+        first_material = extruder_materials[0] if extruder_materials else None
+        gcode_M240_param = rules["gcode_M240_param"].get(first_material)
+        self._M240_line = b"M240 S" + str(gcode_M240_param).encode("utf-8") if gcode_M240_param is not None else None
+
+        self._chamber_temperature = rules["chamber_temperature"]
+
+        # The lowest and highest temperature each extruder may be at, to time the pause of each wait on them. A wait
+        # takes the extruder to its temperature, and setting a temperature without waiting widens the range to it.
+        self._heating_rates = heating_rates
+        self._heater_temperatures = {}  # type: Dict[int, Tuple[int, int]]
+
+        self.initial_extruder = 1
+        self.active_extruder = 1
+        self.previous_extruder = -1
+
+        self.header_found = False
+        self._header_complete = False
+        self._command_buffer = b""
+
+        # The fan speed and each extruder's temperature and whether it was waited for, as last set after the header, so
+        # that commands repeating them can be dropped. None is a fan speed that isn't known.
+        self._drop_redundant = drop_redundant
+        self._fan_speed = None
+        self._extruder_temperatures = {}  # type: Dict[int, Tuple[int, bool]]
+
+        # Totals for the header. The filament used is kept per extruder, in mm, and the print time is in seconds.
+        self.layer_count = 0
+        self._material_lengths = {}
+        self.print_time = 0.0
+        self._reserved_fields = []
+
+        # Some printers seem to _really_ not like G moves that don't have X Y and Z coords so the move codec keeps track
+        # of each coord and rewrites every G move to make sure all coords are included
+        self._move_codec = MoveCodec(G_format)
+
+        # The codec logs the moves for the print time estimate, which takes them in batches along with the pauses and
+        # temperature changes between them
+        self._estimator = None
+        self._move_log = ColumnarMoves.MoveColumns()
+        self._timed_events = []
+        if machine_limits is not None:
+            self._estimator = PrintTimeEstimator(machine_limits)
+            self._estimator.setPosition(self._move_codec.getPosition())
+            self._move_codec.setMoveLog(self._move_log)
+
+        # The rewrite rules are compiled into a lookup table once rather than checked one after another for every line
+        self._compileDispatch()
+
+    ######################################################################
+    ##  Translates lines of Cura g-code and appends them to output, each
+    ##  followed by a newline. May be called repeatedly with consecutive
+    ##  parts of the same job.
+    ######################################################################
+    def translate(self, lines: Iterable[bytes], output: bytearray) -> None:
+        _newline = self.newline
+        skip_prefixes = self._skip_prefixes
+        dispatch = self._dispatch
+        other_prefix_lengths = self._other_prefix_lengths
+
+        for line in lines:
+            line = line.strip()
+
+            # Skip unwanted lines and blank lines, but count the layers even if their markers are skipped
+            if not line:
+                continue
+            if line.startswith(skip_prefixes):
+                if line[:7] == b";LAYER:":
+                    self.layer_count += 1
+                    if self._layer_markers and self.header_found:
+                        output += line
+                        output += _newline
+                continue
+
+            # Moves are by far the most common lines so the two character prefixes are looked up first
+            handler = dispatch.get(line[:2])
+            if handler is None:
+                for length in other_prefix_lengths:
+                    handler = dispatch.get(line[:length])
+                    if handler is not None:
+                        break
+
+            if handler is not None:
+                line = handler(line)
+                if line is None:
+                    continue
+
+            # Cura sometimes throws extruder heat and fan commands in before the g-code start block and this will cause the
+            # "Invalid Format" error when read by the printer, so we'll just store them away until after the header has
+            # been written to the output stream
+            if self.header_found:
+                output += line
+                output += _newline
+            else:
+                self._command_buffer += line + _newline
+
+        self._flushMoveLog()
+
+    ######################################################################
+    ##  Returns the arguments the translator was created with, so that
+    ##  the same translator can be created in another process
+    ######################################################################
+    def getSettings(self) -> Dict:
+        return dict(self._settings)
+
+    ######################################################################
+    ##  Returns the state carried from one line to the next: whether the
+    ##  header was found, the commands buffered before it, the extruders,
+    ##  the formatted position and feedrate, whether the extruder is on
+    ##  and its rate, the extruder temperatures when the print time is
+    ##  estimated, whether the header is complete, the fan speed and
+    ##  temperatures last set and the temperatures each extruder may be
+    ##  at. The totals for the header are not included.
+    ######################################################################
+    def getState(self) -> Tuple:
+        codec = self._move_codec
+        return (self.header_found, self._command_buffer, self.initial_extruder, self.active_extruder, self.previous_extruder, codec.getFormatted(),
+                codec.getFeedrate(), codec.isExtruding(), codec.getExtrusionRate(), self._estimator.getTargets() if self._estimator is not None else None,
+                self._header_complete, self._fan_speed, dict(self._extruder_temperatures), dict(self._heater_temperatures))
+
+    def setState(self, state: Tuple) -> None:
+        self._flushExtrusion()
+        self._flushMoveLog()
+        self.header_found, self._command_buffer, self.initial_extruder, self.active_extruder, self.previous_extruder, formatted, feedrate, extruding, extrusion_rate, targets, \
+            self._header_complete, self._fan_speed, extruder_temperatures, heater_temperatures = state
+        self._extruder_temperatures = dict(extruder_temperatures)
+        self._heater_temperatures = dict(heater_temperatures)
+
+        codec = self._move_codec
+        if formatted is not None:
+            codec.setFormatted(formatted)
+        codec.setFeedrate(feedrate)
+        codec.setExtrusionRate(extrusion_rate)
+        codec.setExtruding(extruding)
+
+        # The extruders are taken to have reached their temperatures, as a state is only set between many layers
+        if self._estimator is not None:
+            self._estimator.setPosition(codec.getPosition())
+            if targets is not None:
+                self._estimator.setTargets(targets)
+
+    ######################################################################
+    ##  Returns the layer count, the filament used by each extruder in
+    ##  mm, keyed by extruder number from 1, and the estimated print time
+    ##  in seconds
+    ######################################################################
+    def getTotals(self) -> Tuple[int, Dict[int, float], float]:
+        self._flushExtrusion()
+        if self._estimator is not None:
+            self._flushMoveLog()
+            self.print_time += self._estimator.takeTime()
+        return self.layer_count, dict(self._material_lengths), self.print_time
+
+    ######################################################################
+    ##  Adds totals returned by getTotals() of a translator which
+    ##  translated part of the same job
+    ######################################################################
+    def addTotals(self, totals: Tuple[int, Dict[int, float], float]) -> None:
+        layer_count, material_lengths, print_time = totals
+        self.layer_count += layer_count
+        self.print_time += print_time
+        for extruder, length in material_lengths.items():
+            self._material_lengths[extruder] = self._material_lengths.get(extruder, 0.0) + length
+
+    ######################################################################
+    ##  Returns the real values of the header fields which were written
+    ##  with a placeholder, padded to the same width, for HeaderPatcher
+    ######################################################################
+    def getHeaderFields(self) -> Dict[str, str]:
+        layer_count, material_lengths, print_time = self.getTotals()
+        largest = 10 ** self.header_field_width - 1
+
+        fields = {}
+        for name in self._reserved_fields:
+            if name == "LayerCount":
+                value = layer_count
+            elif name == "Time":
+                value = max(1, round(print_time / 60))
+            else:
+                value = round(material_lengths.get(int(name[len("MaterialLengthE"):]), 0.0))
+            fields[name] = "%0*d" % (self.header_field_width, min(value, largest))
+        return fields
+
+    ######################################################################
+    ##  Returns True if the printer can be told to heat an extruder up
+    ##  without waiting for it, with the P1 parameter
+    ######################################################################
+    def canSetTemperatureWithoutWaiting(self) -> bool:
+        return self._M104_P_support
+
+    ######################################################################
+    ##  Returns True when scan() can be used. Once the header is complete
+    ##  only tool changes, extruder commands, temperatures, fan commands
+    ##  and moves change the state. scan() skips the header lines, so it
+    ##  couldn't complete the header itself.
+    ######################################################################
+    def canScan(self) -> bool:
+        return self._header_complete and self._move_codec.getFormatted() is not None
+
+    ######################################################################
+    ##  Brings the state up to date with data, whole lines of g-code
+    ##  separated by newlines, without translating it, leaving the state
+    ##  as translate() would. Only the tool changes, the temperatures, the
+    ##  last move to set each parameter and the last extruder commands are
+    ##  looked at, and they are found by searching the text rather than
+    ##  going through it line by line. The totals for the header are not
+    ##  updated.
+    ######################################################################
+    def scan(self, data: bytes) -> None:
+        skip_prefixes = self._skip_prefixes
+        for match in self._scanned_line_finditer(data):
+            line = match.group(1).strip()
+            if line.startswith(skip_prefixes):
+                continue
+            if line[:1] == b"T":
+                self._translateToolChange(line)
+            else:
+                extruder_num, extruder_temp, wait_for_temp = self._parseExtruderTemperature(line)
+                self._setExtruderTemperature(extruder_num, extruder_temp, wait_for_temp)
+                if wait_for_temp:
+                    self._getHeatWaitDwell(extruder_num, extruder_temp)
+                else:
+                    self._setHeaterTarget(extruder_num, extruder_temp)
+                if self._estimator is not None:
+                    self._estimator.settleTemperature(extruder_num, extruder_temp)
+
+        # Whichever of the last fan commands comes later sets the fan speed
+        fan_on, fan_on_line = self._findLastLine(data, b"M106 S", (b"M106 S",))
+        fan_off, fan_off_line = self._findLastLine(data, b"M107", (b"M107",))
+        if fan_on_line is not None and fan_on > fan_off:
+            self._setFanSpeed(self._parseFanSpeed(fan_on_line))
+        elif fan_off_line is not None:
+            self._setFanSpeed(0)
+
+        position, line = self._findLastLine(data, b"M108", (b"M108",))
+        if line is not None:
+            self._translateExtrusionRate(line)
+
+        # Whichever of the last extruder on and off commands comes later decides whether the extruder is on
+        on, on_line = max((self._findLastLine(data, prefix, (prefix,)) for prefix in self._extruder_on_prefixes), key = lambda found: found[0])
+        off, off_line = self._findLastLine(data, b"M103", (b"M103",))
+        if on_line is not None and on > off:
+            self._translateExtruderOn(on_line)
+        elif off_line is not None:
+            self._translateExtruderOff(off_line)
+
+        # Any parameter follows a space as the first one is the command
+        self._move_codec.advance([self._findLastLine(data, parameter, (b"G0", b"G1"))[1] for parameter in (b" X", b" Y", b" Z", b" F")])
+
+    # Returns the position and text of the last line in data which contains needle and starts with one of prefixes once
+    # stripped, skipping lines which aren't translated. Returns -1 and None if there isn't one.
+    def _findLastLine(self, data: bytes, needle: bytes, prefixes: Tuple[bytes, ...]) -> Tuple[int, Optional[bytes]]:
+        end = len(data)
+        while True:
+            found = data.rfind(needle, 0, end)
+            if found < 0:
+                return -1, None
+
+            start = data.rfind(b"\n", 0, found) + 1
+            line_end = data.find(b"\n", found)
+            line = data[start:line_end if line_end >= 0 else len(data)].strip()
+            if line.startswith(prefixes) and not line.startswith(self._skip_prefixes):
+                return start, line
+            end = start
+
+    # Passes the moves logged by the codec on to the print time estimate
+    def _flushMoveLog(self) -> None:
+        if self._move_log or self._timed_events:
+            self._estimator.addMoveColumns(self._move_log, self._timed_events)
+            self._move_log.clear()
+            self._timed_events.clear()
+
+    # Pauses and temperature changes are passed on to the print time estimate with the moves, after the moves logged so
+    # far
+    def _estimateDwell(self, seconds: float) -> None:
+        if self._estimator is not None:
+            self._timed_events.append((len(self._move_log), self._estimator.addDwell, (seconds,)))
+
+    def _estimateTemperature(self, extruder_num: int, extruder_temp: int, wait_for_temp: bool) -> None:
+        if self._estimator is not None:
+            self._timed_events.append((len(self._move_log), self._estimator.setTemperature, (extruder_num, extruder_temp, wait_for_temp)))
+
+    # The filament used so far was used by the active extruder
+    def _flushExtrusion(self) -> None:
+        extruded = self._move_codec.takeExtruded()
+        if extruded:
+            self._material_lengths[self.active_extruder] = self._material_lengths.get(self.active_extruder, 0.0) + extruded
+
+    ######################################################################
+    ##  Checks that the whole job has been translated correctly. Raises
+    ##  GCodeTranslationError if it hasn't.
+    ######################################################################
+    def finish(self) -> None:
+        if not self.header_found:
+            raise GCodeTranslationError(self._plugin_name + " - No g-code header found. Has the machine start gcode been edited?")
+
+    ######################################################################
+    ##  Builds the table used to find the rewrite rule for a line from
+    ##  the start of the line. The prefixes of different rules don't
+    ##  overlap so at most one rule applies to each line.
+    ######################################################################
+    def _compileDispatch(self) -> None:
+        self._extruder_on_prefixes = (b"M101", b"M201", b"M301")
+
+        rules = [
+            ((b"G0", b"G1"), self._move_codec.translate),
+            ((b"^",), self._translateHeader),
+            (tuple(b"T%d" % i for i in range(10)), self._translateToolChange),
+            ((b"M104", b"M109"), self._translateExtruderTemperature if self._M104_P_support else self._translateExtruderTemperatureWithDwell),
+            ((b"M106 S",), self._translateFanSpeed),
+            ((b"M107",), self._translateFanOff),
+            (self._extruder_on_prefixes, self._translateExtruderOn),
+            ((b"M103",), self._translateExtruderOff),
+            ((b"M108",), self._translateExtrusionRate),
+            ((b";LAYER:",), self._translateLayer),
+            ((b"G4",), self._translateDwell)
+        ]
+
+        # The rules which depend on the printer are only added when they change something
+        if self._M240_line is not None:
+            rules.append(((b"M240 S",), self._translateM240))
+        if self._chamber_temperature is not None:
+            prefixes = tuple(self._chamber_temperature[name] for name in ("set", "wait") if name in self._chamber_temperature)
+            rules.append((prefixes, self._translateChamberTemperature))
+
+        self._dispatch = {}
+        for prefixes, handler in rules:
+            for prefix in prefixes:
+                self._dispatch[prefix] = handler
+        self._other_prefix_lengths = sorted({len(prefix) for prefix in self._dispatch if len(prefix) != 2}, reverse = True)
+
+    # Check for g-code header information and substitute in known values
+    def _translateHeader(self, line: bytes) -> Optional[bytes]:
+        # This is usually the first line from machine_gcode_start begins
+        if line.startswith(b"^Firmware"):
+            self.header_found = True
+
+        # This is usually the last line from machine_gcode_start indicating end of the gcode header
+        # Once this is found any pre-header commands that may have been stored away can be output
+        elif line == b"^InitComplete":
+            line = self._command_buffer + line
+            self._header_complete = True
+
+        elif line.startswith(b"^MaterialCode"):
+            extruder_num = int(line[14:15])
+            if extruder_num <= len(self._extruder_materials) and self._extruders_enabled[extruder_num - 1]:
+                material_mapped = self._material_map.get(self._extruder_materials[extruder_num - 1])
+                if material_mapped is None:
+                    raise GCodeTranslationError(self._plugin_name + " - Unsupported filament type selected.")
+
+                line = b"^MaterialCodeE%d:%s" % (extruder_num, str(material_mapped["material_code"]).encode("utf-8"))
+
+        elif line.startswith(b"^MaterialLength"):
+            extruder_num = int(line[16:17])
+            if extruder_num <= len(self._extruder_materials) and self._extruders_enabled[extruder_num - 1]:
+                line = self._reserveHeaderField(b"^MaterialLengthE%d:1" % extruder_num)
+
+        elif line.startswith(b"^LayerCount:"):
+            line = self._reserveHeaderField(line)
+
+        elif line.startswith(b"^Time"):
+            line = b"^Time:%d" % self._print_time_mins
+            if self._estimator is not None:
+                line = self._reserveHeaderField(line)
+
+        return line
+
+    # T<int> sets active extruder.  CubePro does not use this as there are separate g-code commands for each extruder.
+    # However we need to store it away so that subsequent extruder specific commands can specify the active extruder.
+    def _translateToolChange(self, line: bytes) -> Optional[bytes]:
+        if len(line) != 2:
+            return line
+
+        if self.previous_extruder == -1:
+            self.initial_extruder = int(line[1:]) + 1
+
+        self._flushExtrusion()
+        self.previous_extruder = self.active_extruder
+        self.active_extruder = int(line[1:]) + 1
+        return None # skip this line
+
+    # Pads the value of a header field to a fixed width, so that it can be patched with the real value once the whole job
+    # has been translated. The field is left as it is when it won't be patched or doesn't hold a whole number.
+    def _reserveHeaderField(self, line: bytes) -> bytes:
+        name, _, value = line[1:].partition(b":")
+        value = value.strip()
+        if not self._reserve_header_fields or not value.isdigit():
+            return line
+        self._reserved_fields.append(name.decode("ascii"))
+        return b"^%s:%0*d" % (name, self.header_field_width, int(value))
+
+    # ;LAYER:<int> starts each layer. It is normally skipped along with the other comments but counted either way.
+    def _translateLayer(self, line: bytes) -> Optional[bytes]:
+        self.layer_count += 1
+        return line
+
+    # G4 pauses for P<int> (or S<int>) units, which are passed on as they are but timed
+    def _translateDwell(self, line: bytes) -> Optional[bytes]:
+        for gcode_arg in line.split(b" ")[1:]:
+            if gcode_arg[:1] in (b"P", b"S"):
+                self._estimateDwell(float(gcode_arg[1:]) * self._dwell_units)
+        return line
+
+    # Cura's BFB flavour switches the extruder on with M101 (M201 and M301 for the second and third extruder) and off
+    # with M103, and sets its speed in RPM with M108 S<float>. These are passed on as they are, but followed to add up
+    # the filament used.
+    def _translateExtruderOn(self, line: bytes) -> Optional[bytes]:
+        self._move_codec.setExtruding(True)
+        return line
+
+    def _translateExtruderOff(self, line: bytes) -> Optional[bytes]:
+        self._move_codec.setExtruding(False)
+        return line
+
+    def _translateExtrusionRate(self, line: bytes) -> Optional[bytes]:
+        for gcode_arg in line.split(b" "):
+            if gcode_arg[:1] == b"S":
+                self._move_codec.setExtrusionRate(float(gcode_arg[1:]) * self._bfb_mm_per_revolution)
+        return line
+
+    # M240 command is used in the init g-code but it is not properly defined. It seems to be used on CubePro and Cube3
+    # but the parameters are different. Cube3 params are X<int> Y<int> S<int>. CubePro params are S<int> however the
+    # values are much higher on CubePro than on Cube3.
+    # Different materials seem to use different values so we'll try to match it based on material in Extruder 1
+    def _translateM240(self, line: bytes) -> Optional[bytes]:
+        return self._M240_line
+
+    # M104 and M109 sets extruder temperature, with M109 triggering a pause until desired temperature is reached.
+    # An optional paramater T<int> specifies an extruder number, and if omitted the active extruder will be used.
+    # CubePro sets extruder temperature using M104, M204, and M304 for each extruder respectively and each command has
+    # an optional P1 parameter which if omitted will trigger a pause until desired temperature is reached.
+    def _translateExtruderTemperature(self, line: bytes) -> Optional[bytes]:
+        extruder_num, extruder_temp, wait_for_temp = self._parseExtruderTemperature(line)
+        if wait_for_temp:
+            self._getHeatWaitDwell(extruder_num, extruder_temp)
+        else:
+            self._setHeaterTarget(extruder_num, extruder_temp)
+        if not self._setExtruderTemperature(extruder_num, extruder_temp, wait_for_temp):
+            return None
+
+        self._estimateTemperature(extruder_num, extruder_temp, wait_for_temp)
+        if wait_for_temp:
+            return b"M%d04 S%d" % (extruder_num, extruder_temp)
+        return b"M%d04 S%d P1" % (extruder_num, extruder_temp)
+
+    # The same for printers without P support, which set the temperature and go on
+    def _translateExtruderTemperatureWithDwell(self, line: bytes) -> Optional[bytes]:
+        extruder_num, extruder_temp, wait_for_temp = self._parseExtruderTemperature(line)
+        if wait_for_temp:
+            dwell = self._getHeatWaitDwell(extruder_num, extruder_temp)
+        else:
+            dwell = 0
+            self._setHeaterTarget(extruder_num, extruder_temp)
+        if not self._setExtruderTemperature(extruder_num, extruder_temp, wait_for_temp):
+            return None
+
+        line = b"M%d04 S%d" % (extruder_num, extruder_temp)
+        self._estimateTemperature(extruder_num, extruder_temp, False)
+
+        # P unsupported so just add a pause with G4 when waiting, long enough for the extruder to get from any
+        # temperature it may be at to this one. Waiting again for the same temperature, with no other set in between,
+        # doesn't need one.
+        if dwell:
+            line += self.newline + b"G4 P%d" % dwell
+            self._estimateDwell(dwell * self._dwell_units)
+        return line
+
+    # Returns the extruder number, temperature and whether to wait for it of an M104 or M109 command
+    def _parseExtruderTemperature(self, line: bytes) -> Tuple[int, int, bool]:
+        extruder_temp = 0
+        extruder_num = self.active_extruder
+        wait_for_temp = line[3:4] == b"9" # M109 = wait for temp
+
+        gcode_args = line.split(b" ")
+        for gcode_arg in gcode_args:
+            parameter = gcode_arg[:1]
+            if parameter == b"S":
+                extruder_temp = round(float(gcode_arg[1:]))
+            elif parameter == b"T":
+                extruder_num = int(gcode_arg[1:2]) + 1
+            elif parameter == b"P":
+                wait_for_temp = gcode_arg[1:2] == b"0"
+        return extruder_num, extruder_temp, wait_for_temp
+
+    # Returns how many seconds to pause for extruder_num to heat up or cool down to extruder_temp from whichever
+    # temperature it may be at takes longest, then takes it to be at that temperature. The pause is fixed when the
+    # heating rates aren't known.
+    def _getHeatWaitDwell(self, extruder_num: int, extruder_temp: int) -> int:
+        lowest, highest = self._heater_temperatures.get(extruder_num, (self._room_temperature, self._room_temperature))
+        self._heater_temperatures[extruder_num] = (extruder_temp, extruder_temp)
+        if self._heating_rates is None:
+            return self._heat_wait_dwell
+
+        heat_up_rate, cool_down_rate = self._heating_rates
+        heat_up_time = max(0, extruder_temp - lowest) / heat_up_rate
+        cool_down_time = max(0, highest - extruder_temp) / cool_down_rate
+        return math.ceil(max(heat_up_time, cool_down_time) / self._dwell_units)
+
+    # Setting a temperature without waiting leaves the extruder anywhere between where it was and that temperature, or
+    # room temperature when it is switched off
+    def _setHeaterTarget(self, extruder_num: int, extruder_temp: int) -> None:
+        lowest, highest = self._heater_temperatures.get(extruder_num, (self._room_temperature, self._room_temperature))
+        extruder_temp = max(extruder_temp, self._room_temperature)
+        self._heater_temperatures[extruder_num] = (min(lowest, extruder_temp), max(highest, extruder_temp))
+
+    # Keeps track of the temperature set after the header. Returns False if the command can be dropped, which is when it
+    # sets the temperature already set or waits again for the temperature last waited for.
+    def _setExtruderTemperature(self, extruder_num: int, extruder_temp: int, wait_for_temp: bool) -> bool:
+        if not self._header_complete:
+            return True
+
+        previous = self._extruder_temperatures.get(extruder_num)
+        if self._drop_redundant and previous is not None and previous[0] == extruder_temp and (previous[1] or not wait_for_temp):
+            return False
+        self._extruder_temperatures[extruder_num] = (extruder_temp, wait_for_temp)
+        return True
+
+    # M106 sets fan speed with S<int> parameter which has a range of 0-255. CubePro uses a P<int> parameter with a range
+    # of 0-100. This converts to CubePro format M106 or change to M107 command (turn fan off) instead if fan speed is 0.
+    def _translateFanSpeed(self, line: bytes) -> Optional[bytes]:
+        fan_speed = self._parseFanSpeed(line)
+        if not self._setFanSpeed(fan_speed):
+            return None
+        if fan_speed == 0:
+            return b"M107"
+        self._estimateDwell(2 * self._dwell_units)
+        return b"M106 P%d" % fan_speed + self.newline + b"G4 P2"
+
+    # M107 turns the fan off
+    def _translateFanOff(self, line: bytes) -> Optional[bytes]:
+        return line if self._setFanSpeed(0) else None
+
+    def _parseFanSpeed(self, line: bytes) -> int:
+        return round(float(line[6:]) / 2.55)
+
+    # Keeps track of the fan speed set after the header. Returns False if the command can be dropped as the fan already
+    # runs at that speed.
+    def _setFanSpeed(self, fan_speed: int) -> bool:
+        if not self._header_complete:
+            return True
+        if self._drop_redundant and fan_speed == self._fan_speed:
+            return False
+        self._fan_speed = fan_speed
+        return True
+
+    # M141 and M191 sets chamber temperature, with M191 triggering a pause until desired temperature is reached.
+    # CubePro uses M404 with optional P1 paramater which if omitted will trigger a pause until desired temperature
+    # is reached. The commands come from the rules of the printer, and the wait is only translated when they name it.
+    def _translateChamberTemperature(self, line: bytes) -> Optional[bytes]:
+        # if P parameter is present then this line is probably from start/end gcode so strip out P0 and leave P1 alone
+        if b"P0" in line:
+            line = line[:-3]
+        elif b"P1" not in line:
+            build_volume_temperature = int(line.partition(b" S")[2].split(b" ")[0])
+            add_P1 = line.startswith(self._chamber_temperature["set"]) # if this is M141 then add P1
+            line = self._chamber_temperature["command"] + b" S%d" % build_volume_temperature
+            if add_P1:
+                line += b" P1"
+        return line
+
+
+class GCodeLineSink:
+    # A write-only text stream for GCodeWriter to write Cura's g-code into. Each chunk of text is encoded once, split
+    # into lines and translated into a reused bytearray which is then passed on to output, so only the chunk being
+    # written and an incomplete last line are held in memory. With a parallel translator the text is instead collected
+    # into batches large enough for it to translate on all cores. The translated g-code goes through each of passes in
+    # turn on its way to output, such as a MoveMerger. A pass has a process() method which takes whole translated lines
+    # and returns what it lets through so far, and a flush() method which returns whatever it still holds at the end.
+    # With a LayerCache each chunk of whole lines written after the header is looked up in it, and only translated if
+    # it isn't there.
+    def __init__(self, translator: GCodeTranslator, output, parallel_translator = None, passes: Sequence = (), layer_cache = None) -> None:
+        self._translator = translator
+        self._output = output
+        self._parallel_translator = parallel_translator
+        self._passes = list(passes)
+        self._layer_cache = layer_cache
+        self._partial_line = b""
+        self._pending = bytearray()
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if self._parallel_translator is not None:
+            self._pending += text.encode("utf-8")
+            if len(self._pending) >= self._parallel_translator.getThreshold():
+                # Keep an incomplete last line for the next batch
+                end = self._pending.rfind(b"\n") + 1
+                if end:
+                    self._translateBatch(bytes(self._pending[:end]))
+                    del self._pending[:end]
+            return len(text)
+
+        data = text.encode("utf-8")
+        if self._layer_cache is not None and not self._partial_line and data.endswith(b"\n") and self._translator.canScan():
+            self._translateLayer(data)
+            return len(text)
+
+        lines = (self._partial_line + data).split(b"\n")
+        self._partial_line = lines.pop()
+        self._translateLines(lines)
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    ######################################################################
+    ##  Translates the last line if it didn't end with a newline and
+    ##  checks the whole job was translated
+    ######################################################################
+    def close(self) -> None:
+        if self._pending:
+            self._translateBatch(bytes(self._pending))
+            self._pending.clear()
+        if self._partial_line:
+            self._translateLines([self._partial_line])
+            self._partial_line = b""
+        # What each pass held back still goes through the passes after it
+        for index, output_pass in enumerate(self._passes):
+            self._write(output_pass.flush(), index + 1)
+        self._translator.finish()
+
+    def _translateLines(self, lines: List[bytes]) -> None:
+        self._translator.translate(lines, self._buffer)
+        self._writeBuffer()
+
+    # Translates a chunk of whole lines, or takes its translation from the cache. canScan() tells that the state holds
+    # everything the translation depends on.
+    def _translateLayer(self, data: bytes) -> None:
+        translator = self._translator
+        key = self._layer_cache.getKey(data, translator.getState())
+        entry = self._layer_cache.get(key)
+        if entry is not None:
+            output, state, totals = entry
+            translator.setState(state)
+            translator.addTotals(totals)
+            self._buffer += output
+        else:
+            layer_count, material_lengths, print_time = translator.getTotals()
+            translator.translate(data.split(b"\n")[:-1], self._buffer)
+            totals = translator.getTotals()
+            totals = (totals[0] - layer_count, {extruder: length - material_lengths.get(extruder, 0.0) for extruder, length in totals[1].items()}, totals[2] - print_time)
+            self._layer_cache.put(key, bytes(self._buffer), translator.getState(), totals)
+        self._writeBuffer()
+
+    def _translateBatch(self, data: bytes) -> None:
+        self._parallel_translator.translate(self._translator, data, self._buffer)
+        self._writeBuffer()
+
+    def _writeBuffer(self) -> None:
+        if self._buffer:
+            self._write(self._buffer)
+            self._buffer.clear()
+
+    def _write(self, data, first_pass: int = 0) -> None:
+        for output_pass in self._passes[first_pass:]:
+            data = output_pass.process(data)
+        if data:
+            self._output.write(data)
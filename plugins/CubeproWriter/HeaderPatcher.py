@@ -0,0 +1,247 @@
+####################################################################
+#  HeaderPatcher for the CubeproWriter plugin
+#
+#  Changes header fields such as ^MaterialCodeE1 or ^Time of existing
+#  .cube, .cube3, .cubex and .cubepro print files without re-slicing.
+#  The files are encrypted in ECB mode so when the length of the
+#  header doesn't change only the blocks containing changed bytes are
+#  re-encrypted. Otherwise the file is re-encrypted from the first
+#  changed block onwards.
+#
+#  A file which is still being written can be patched the same way,
+#  from the plaintext it started with, if the fields keep their length.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import os
+import shutil
+
+from typing import Dict, List, Optional, Tuple
+
+from .blowfish import Blowfish
+from .BlowfishECBWriter import BlowfishECBWriter
+from .KeyScheduleCache import KeyScheduleCache
+
+
+class HeaderPatcher:
+    # Encryption key used by each print file format
+    file_keys = {
+        ".cube": b"221BBakerMycroft",
+        ".cube3": b"221BBakerMycroft",
+        ".cubepro": b"221BBakerMycroft",
+        ".cubex": b"kWd$qG*25Xmgf-Sg"
+    }
+
+    # The header ends with the ^InitComplete line
+    _header_end = b"^InitComplete\r\n"
+    _max_header_size = 64 * 1024
+
+    # Enough plaintext from the start of a file to be sure it contains the whole header, for patchStream()
+    header_prefix_size = _max_header_size + 8
+    _read_size = 4096
+    _copy_size = 1024 * 1024
+
+    def __init__(self, cipher: Blowfish, compatibility_mode: bool = True) -> None:
+        self._cipher = cipher
+        self._compatibility_mode = compatibility_mode
+
+    ######################################################################
+    ##  Creates a patcher using the key of the print file format of path
+    ######################################################################
+    @classmethod
+    def forFile(cls, path: str, key_schedule_cache: Optional[KeyScheduleCache] = None) -> "HeaderPatcher":
+        key = cls.file_keys.get(os.path.splitext(path)[1].lower())
+        if key is None:
+            raise ValueError("Unsupported print file type: " + path)
+        if key_schedule_cache is None:
+            key_schedule_cache = KeyScheduleCache()
+        return cls(key_schedule_cache.getCipher(key))
+
+    ######################################################################
+    ##  Returns the decrypted header of the print file open in stream
+    ######################################################################
+    def readHeader(self, stream) -> bytes:
+        prefix, at_end = self._readPrefix(stream)
+        return prefix[:self._findHeaderEnd(prefix)]
+
+    ######################################################################
+    ##  Returns the header fields as a list of (name, value) tuples in
+    ##  file order, for example ("MaterialCodeE1", "209")
+    ######################################################################
+    @staticmethod
+    def getFields(header: bytes) -> List[Tuple[str, str]]:
+        fields = []
+        for line in header.split(b"\r\n"):
+            colon = line.find(b":")
+            if line.startswith(b"^") and colon > 0:
+                fields.append((line[1:colon].decode("ascii"), line[colon + 1:].decode("ascii")))
+        return fields
+
+    ######################################################################
+    ##  Returns header with the values of the named fields replaced.
+    ##  Raises KeyError if any of the fields is not in the header.
+    ######################################################################
+    @staticmethod
+    def setFields(header: bytes, fields: Dict[str, str]) -> bytes:
+        remaining = set(fields)
+        lines = header.split(b"\r\n")
+        for i, line in enumerate(lines):
+            colon = line.find(b":")
+            if not line.startswith(b"^") or colon <= 0:
+                continue
+            name = line[1:colon].decode("ascii")
+            if name in fields:
+                lines[i] = line[:colon + 1] + str(fields[name]).encode("ascii")
+                remaining.discard(name)
+
+        if remaining:
+            raise KeyError("Header fields not found: " + ", ".join(sorted(remaining)))
+        return b"\r\n".join(lines)
+
+    ######################################################################
+    ##  Changes header fields of the print file at path, or of a copy of
+    ##  it written to output_path. Returns the number of blocks that
+    ##  were re-encrypted.
+    ######################################################################
+    def patchFile(self, path: str, fields: Dict[str, str], output_path: Optional[str] = None) -> int:
+        with open(path, "rb") as stream:
+            prefix, at_end = self._readPrefix(stream)
+            header_length = self._findHeaderEnd(prefix)
+            new_prefix = self.setFields(prefix[:header_length], fields) + prefix[header_length:]
+
+            if len(new_prefix) != len(prefix):
+                # Everything after the first change moves, so write a new file and swap it in when done
+                target = output_path if output_path is not None else path
+                temp_path = target + ".tmp"
+                try:
+                    with open(temp_path, "wb") as output:
+                        blocks = self._rewriteFrom(stream, output, prefix, new_prefix, at_end)
+                    os.replace(temp_path, target)
+                except BaseException:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
+                return blocks
+
+        if output_path is not None:
+            shutil.copyfile(path, output_path)
+            path = output_path
+
+        with open(path, "r+b") as stream:
+            return self._patchBlocks(stream, prefix, new_prefix)
+
+    ######################################################################
+    ##  Changes header fields of a print file which has been written to
+    ##  stream from offset start onwards, given the plaintext it begins
+    ##  with, which must include the whole header, or be the whole file.
+    ##  The new values must have the same length as the old ones. Only
+    ##  the changed blocks are re-encrypted, and the number of them is
+    ##  returned. The stream is left positioned where it was.
+    ######################################################################
+    def patchStream(self, stream, start: int, prefix: bytes, fields: Dict[str, str]) -> int:
+        header_length = self._findHeaderEnd(prefix)
+        prefix = prefix[:header_length + -header_length % 8]
+        new_prefix = self.setFields(prefix[:header_length], fields) + prefix[header_length:]
+        if len(new_prefix) != len(prefix):
+            raise ValueError("Header fields can only be patched while the file is written if they keep their length")
+
+        position = stream.tell()
+        try:
+            return self._patchBlocks(stream, prefix, new_prefix, start)
+        finally:
+            stream.seek(position)
+
+    ######################################################################
+    ##  Decrypts blocks from the start of stream until the end of the
+    ##  header has been seen. Returns the plaintext and whether the whole
+    ##  file was read, in which case the padding has been removed.
+    ######################################################################
+    def _readPrefix(self, stream) -> Tuple[bytes, bool]:
+        stream.seek(0)
+        prefix = b""
+        while True:
+            data = stream.read(self._read_size)
+            if len(data) % 8:
+                raise ValueError("Print file is not a whole number of cipher blocks long")
+            if not data:
+                return self._removePadding(prefix), True
+
+            prefix += self._cipher.decrypt_blocks(data, self._compatibility_mode)
+
+            # Stop once the end of the header is in the prefix, reading at least one more byte so that a trailing
+            # padding block is always detected
+            if self._header_end in prefix:
+                next_data = stream.read(8)
+                if not next_data:
+                    return self._removePadding(prefix), True
+                stream.seek(-len(next_data), os.SEEK_CUR)
+                return prefix, False
+
+            if len(prefix) > self._max_header_size:
+                raise ValueError("No print file header found")
+
+    def _findHeaderEnd(self, prefix: bytes) -> int:
+        end = prefix.find(self._header_end)
+        if end < 0:
+            raise ValueError("No print file header found")
+        return end + len(self._header_end)
+
+    @staticmethod
+    def _removePadding(plaintext: bytes) -> bytes:
+        padding = plaintext[-1] if plaintext else 0
+        if not 1 <= padding <= 8 or plaintext[-padding:] != bytes([padding]) * padding:
+            raise ValueError("Print file has invalid padding, is the encryption key right?")
+        return plaintext[:-padding]
+
+    def _patchBlocks(self, stream, prefix: bytes, new_prefix: bytes, start: int = 0) -> int:
+        # Re-encrypt only the blocks which changed. The prefix is block aligned unless the whole file was read,
+        # in which case the padding was removed and is put back here so that the last block can be compared.
+        if len(prefix) % 8:
+            padding = 8 - len(prefix) % 8
+            prefix += bytes([padding]) * padding
+            new_prefix += bytes([padding]) * padding
+
+        blocks = 0
+        for offset in range(0, len(prefix), 8):
+            block = new_prefix[offset:offset + 8]
+            if block != prefix[offset:offset + 8]:
+                stream.seek(start + offset)
+                stream.write(self._cipher.encrypt_blocks(block, self._compatibility_mode))
+                blocks += 1
+        return blocks
+
+    def _rewriteFrom(self, stream, output, prefix: bytes, new_prefix: bytes, at_end: bool) -> int:
+        # Copy the encrypted blocks before the first change as they are
+        start = 0
+        while start < min(len(prefix), len(new_prefix)) and prefix[start] == new_prefix[start]:
+            start += 1
+        start -= start % 8
+
+        stream.seek(0)
+        output.write(stream.read(start))
+
+        writer = BlowfishECBWriter(output, self._cipher, self._compatibility_mode)
+        writer.write(new_prefix[start:])
+
+        if not at_end:
+            # Decrypt and re-encrypt the rest, holding back the last block so its padding can be removed
+            stream.seek(len(prefix))
+            pending = b""
+            while True:
+                data = stream.read(self._copy_size)
+                if len(data) % 8:
+                    raise ValueError("Print file is not a whole number of cipher blocks long")
+                if not data:
+                    break
+                plaintext = pending + self._cipher.decrypt_blocks(data, self._compatibility_mode)
+                writer.write(plaintext[:-8])
+                pending = plaintext[-8:]
+            writer.write(self._removePadding(pending))
+
+        writer.close()
+        return (output.tell() - start) // 8
@@ -0,0 +1,108 @@
+####################################################################
+#  KeyScheduleCache for the CubeproWriter plugin
+#
+#  Deriving a Blowfish key schedule takes 521 full block encryptions.
+#  The Cube print file formats only ever use a handful of fixed keys
+#  so the derived schedules are kept in memory for the lifetime of the
+#  process and serialized to the plugin storage directory so that they
+#  survive restarts of Cura.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import hashlib
+import os
+import struct
+
+from typing import Dict, Optional, Tuple
+
+from .blowfish import Blowfish
+
+
+class KeyScheduleCache:
+    # Schedules are shared between all instances, and so between all of the writer plugins
+    _schedules = {}  # type: Dict[str, Tuple[list, list]]
+
+    # File layout: magic, format version, sha256 of the payload, then the 18 P-array entries
+    # followed by the 4 x 256 S-box entries as little endian 32-bit words
+    _file_magic = b"CBKS"
+    _file_version = 1
+    _header = struct.Struct("<4sI32s")
+    _payload = struct.Struct("<%dI" % (18 + 4 * 256))
+
+    def __init__(self, storage_path: Optional[str] = None) -> None:
+        self._storage_path = storage_path
+
+    ######################################################################
+    ##  Returns a cipher for key, deriving its schedule only if it has
+    ##  not been seen before in this process or in the storage directory
+    ######################################################################
+    def getCipher(self, key: bytes) -> Blowfish:
+        key_hash = hashlib.sha256(key).hexdigest()
+
+        schedule = self._schedules.get(key_hash)
+        if schedule is None:
+            schedule = self._load(key_hash)
+            if schedule is None:
+                schedule = Blowfish(key).schedule()
+                self._save(key_hash, schedule)
+            self._schedules[key_hash] = schedule
+
+        return Blowfish.from_schedule(*schedule, key = key)
+
+    def _getFilePath(self, key_hash: str) -> Optional[str]:
+        if not self._storage_path:
+            return None
+        return os.path.join(self._storage_path, "blowfish_" + key_hash[:32] + ".schedule")
+
+    def _load(self, key_hash: str) -> Optional[Tuple[list, list]]:
+        file_path = self._getFilePath(key_hash)
+        if file_path is None or not os.path.isfile(file_path):
+            return None
+
+        try:
+            with open(file_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        # Anything that doesn't look exactly right is ignored and the schedule derived again
+        if len(data) != self._header.size + self._payload.size:
+            return None
+        magic, version, checksum = self._header.unpack_from(data)
+        payload = data[self._header.size:]
+        if magic != self._file_magic or version != self._file_version or checksum != hashlib.sha256(payload).digest():
+            return None
+
+        words = self._payload.unpack(payload)
+        return list(words[:18]), [list(words[18 + i * 256:18 + (i + 1) * 256]) for i in range(4)]
+
+    def _save(self, key_hash: str, schedule: Tuple[list, list]) -> None:
+        file_path = self._getFilePath(key_hash)
+        if file_path is None:
+            return
+
+        p_boxes, s_boxes = schedule
+        words = list(p_boxes)
+        for s_box in s_boxes:
+            words.extend(s_box)
+        payload = self._payload.pack(*words)
+        header = self._header.pack(self._file_magic, self._file_version, hashlib.sha256(payload).digest())
+
+        # Write to a temporary file first so that a concurrent export never sees a partial file.
+        # The cache is only an optimisation so failing to write it is not an error.
+        temp_path = file_path + ".%d.tmp" % os.getpid()
+        try:
+            os.makedirs(self._storage_path, exist_ok = True)
+            with open(temp_path, "wb") as f:
+                f.write(header + payload)
+            os.replace(temp_path, file_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
@@ -0,0 +1,120 @@
+####################################################################
+#  LayerCache for the CubeproWriter plugin
+#
+#  Keeps the translated g-code of each layer of the last export so
+#  that exporting the same job again, or a job with only a few layers
+#  changed, only translates the layers that changed. A layer is looked
+#  up by a hash of its g-code from Cura together with the translator's
+#  settings and its state at the start of the layer, which is all its
+#  translation depends on once the header is complete. A hit brings the
+#  translated g-code, the state at the end of the layer and what the
+#  layer adds to the totals.
+#
+#  Entries the current export doesn't use are dropped when it finishes,
+#  so the cache holds no more than one job, and a layer isn't kept once
+#  the cache is full. Slicing again doesn't empty it, since a layer
+#  whose g-code didn't change is found by the same key. The writer
+#  empties it when the machine changes.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import hashlib
+
+from typing import Dict, Optional, Tuple
+
+# The translated g-code of a layer, the translator state after it and the totals it adds
+CacheEntry = Tuple[bytes, Tuple, Tuple[int, Dict[int, float], float]]
+
+
+class LayerCache:
+    def __init__(self, max_size: int = 64 * 1024 * 1024) -> None:
+        # max_size is the most translated g-code in bytes that is kept
+        self._max_size = max_size
+
+        # The entries of the last export that finished, and those used or added by the current one
+        self._entries = {}  # type: Dict[bytes, CacheEntry]
+        self._current = {}  # type: Dict[bytes, CacheEntry]
+        self._current_size = 0
+
+        self._settings_hash = b""
+        self._hits = 0
+        self._misses = 0
+
+    ######################################################################
+    ##  Starts an export with a translator created with settings
+    ######################################################################
+    def start(self, settings: Dict) -> None:
+        self._settings_hash = hashlib.sha256(repr(sorted(settings.items())).encode("utf-8")).digest()
+        self._current = {}
+        self._current_size = 0
+        self._hits = 0
+        self._misses = 0
+
+    ######################################################################
+    ##  Returns the key of a layer, from its g-code and the translator
+    ##  state at its start
+    ######################################################################
+    def getKey(self, gcode: bytes, state: Tuple) -> bytes:
+        key = hashlib.sha256(self._settings_hash)
+        key.update(repr(state).encode("utf-8"))
+        key.update(gcode)
+        return key.digest()
+
+    ######################################################################
+    ##  Returns the entry for key, or None if the layer has to be
+    ##  translated
+    ######################################################################
+    def get(self, key: bytes) -> Optional[CacheEntry]:
+        entry = self._current.get(key)
+        if entry is None:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._keep(key, entry)
+
+        if entry is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return entry
+
+    ######################################################################
+    ##  Keeps the translation of a layer for the next export
+    ######################################################################
+    def put(self, key: bytes, output: bytes, state: Tuple, totals: Tuple[int, Dict[int, float], float]) -> None:
+        self._keep(key, (output, state, totals))
+
+    ######################################################################
+    ##  Replaces the entries with those used by the export that has just
+    ##  finished. The entries are left as they were if it failed.
+    ######################################################################
+    def finish(self) -> None:
+        self._entries = self._current
+        self._current = {}
+        self._current_size = 0
+
+    ######################################################################
+    ##  Drops every entry. An export in progress goes on adding to the
+    ##  cache from empty.
+    ######################################################################
+    def clear(self) -> None:
+        self._entries = {}
+        self._current = {}
+        self._current_size = 0
+
+    ######################################################################
+    ##  Returns the number of layers found in the cache and translated
+    ##  during the current or last export
+    ######################################################################
+    def getStatistics(self) -> Tuple[int, int]:
+        return self._hits, self._misses
+
+    def _keep(self, key: bytes, entry: CacheEntry) -> None:
+        if key in self._current or self._current_size + len(entry[0]) > self._max_size:
+            return
+        self._current[key] = entry
+        self._current_size += len(entry[0])
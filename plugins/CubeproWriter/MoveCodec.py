@@ -0,0 +1,304 @@
+####################################################################
+#  MoveCodec for the CubeproWriter plugin
+#
+#  Rewrites G0/G1 moves so that each one has X, Y and Z coordinates,
+#  formatted with the precision of the print file format.
+#
+#  Moves are matched against a regular expression for the way Cura
+#  writes them. Coordinates which already have no more decimals than
+#  the output precision are padded with zeros instead of being parsed
+#  and formatted again, and the formatted coordinates are kept so that
+#  an axis which doesn't move (usually Z) is only formatted once. Any
+#  other move goes through the general parser. Both give exactly the
+#  same output as formatting the parsed values with G_format. Moves are
+#  read and written as bytes.
+#
+#  The codec also adds up the filament used by the moves. Cura's BFB
+#  flavour has no E parameter. Instead the extruder is switched on and
+#  off around the moves and runs at a set rate, so the filament used by
+#  a move is its length times the extrusion rate over its feedrate.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import math
+import re
+
+from string import Formatter
+from typing import List, Optional, Tuple
+
+
+class MoveCodec:
+    def __init__(self, G_format: str) -> None:
+        # G_format is a str.format() template taking the command, X, Y and Z, for example "{0} X{1:.3f} Y{2:.3f} Z{3:.4f}"
+        self._G_format = G_format
+
+        # The initial Z pos is 5mm above bed to avoid accidental collision between bed and printhead
+        self._positions = [float(0), float(0), float(5)]
+        self._template = None
+
+        # The feedrate in mm/min stays in effect until a move changes it. While the extruder is on the filament used is
+        # added to extruded, the extrusion rate being in mm of filament per minute.
+        self._feedrate = 0.0
+        self._extruding = False
+        self._extrusion_rate = 0.0
+        self._active_rate = 0.0
+        self._extrusion_position = None
+        self.extruded = 0.0
+
+        # Each move can be logged as its X, Y and Z and feedrate for the print time estimate, through the append methods
+        # of the columns of a ColumnarMoves.MoveColumns
+        self._move_log = None
+        self._move_log_appenders = None
+
+        move_format = parseMoveFormat(G_format)
+        if move_format is not None:
+            literals, precisions = move_format
+            self._template = b"%s".join(literal.replace(b"%", b"%%") for literal in literals)
+            self._format_specs = [b"%%.%df" % precision for precision in precisions]
+            self._formatted = [format_spec % position for format_spec, position in zip(self._format_specs, self._positions)]
+            self._padding = [self._createPadding(precision) for precision in precisions]
+
+            # Cura writes the parameters of its moves in this order. Each coordinate is matched as its integer part
+            # and its decimals including the point.
+            self._move_match = re.compile(r"(G[01])(?: F(\S*))?(?: X{0})?(?: Y{1})?(?: Z{2})?(?: E\S*)?".format(
+                *[self._numberPattern(precision) for precision in precisions]).encode("ascii")).fullmatch
+
+    ######################################################################
+    ##  Returns the rewritten move for line, a G0 or G1 command
+    ######################################################################
+    def translate(self, line: bytes) -> bytes:
+        if self._template is None:
+            return self._translateFormat(line)
+
+        match = self._move_match(line)
+        if match is None:
+            return self._translateTokens(line)
+
+        command, feedrate, x, x_decimals, y, y_decimals, z, z_decimals = match.groups()
+        if feedrate is not None:
+            feedrate = float(feedrate)
+            self._feedrate = round(feedrate, 1)
+
+        # The coordinates have no more decimals than the precision, so padding them with zeros gives the same result
+        # as formatting the floats they parse to. An axis which isn't in the move keeps its formatted coordinate.
+        formatted = self._formatted
+        padding = self._padding
+        if x is not None:
+            formatted[0] = x + x_decimals + padding[0][len(x_decimals)] if x_decimals else x + padding[0][0]
+        if y is not None:
+            formatted[1] = y + y_decimals + padding[1][len(y_decimals)] if y_decimals else y + padding[1][0]
+        if z is not None:
+            formatted[2] = z + z_decimals + padding[2][len(z_decimals)] if z_decimals else z + padding[2][0]
+
+        if self._active_rate or self._move_log is not None:
+            self._trackMove(self.getPosition())
+
+        line = self._template % (command, formatted[0], formatted[1], formatted[2])
+        if feedrate is not None:
+            line += b" F%.1f" % feedrate
+        return line
+
+    ######################################################################
+    ##  Returns the formatted X, Y and Z coordinates of the current
+    ##  position, or None when G_format isn't a plain template
+    ######################################################################
+    def getFormatted(self) -> Optional[List[bytes]]:
+        if self._template is None:
+            return None
+        return list(self._formatted)
+
+    ######################################################################
+    ##  Sets the current position from formatted X, Y and Z coordinates,
+    ##  for when moves have been rewritten elsewhere
+    ######################################################################
+    def setFormatted(self, formatted: List[bytes]) -> None:
+        self._formatted = list(formatted)
+        if self._extruding:
+            self._extrusion_position = self.getPosition()
+
+    ######################################################################
+    ##  Moves the position and feedrate on as if moves had been
+    ##  translated, given the last of them to set each of X, Y, Z and F,
+    ##  or None for a parameter that none of them set
+    ######################################################################
+    def advance(self, last_moves: List[Optional[bytes]]) -> None:
+        for index, parameter in enumerate((b"X", b"Y", b"Z", b"F")):
+            line = last_moves[index]
+            if line is None:
+                continue
+            for gcode_arg in reversed(line.split(b" ")):
+                if gcode_arg[:1] == parameter:
+                    if index == 3:
+                        self._feedrate = round(float(gcode_arg[1:]), 1)
+                    else:
+                        self._formatted[index] = self._format_specs[index] % float(gcode_arg[1:])
+                    break
+
+        if self._extruding:
+            self._extrusion_position = self.getPosition()
+
+    ######################################################################
+    ##  Returns the current position as floats
+    ######################################################################
+    def getPosition(self) -> List[float]:
+        if self._template is None:
+            return list(self._positions)
+        return list(map(float, self._formatted))
+
+    def getFeedrate(self) -> float:
+        return self._feedrate
+
+    def setFeedrate(self, feedrate: float) -> None:
+        self._feedrate = feedrate
+
+    ######################################################################
+    ##  Appends the X, Y, Z and feedrate of each move translated from now
+    ##  on to the columns of move_log, a ColumnarMoves.MoveColumns. None
+    ##  stops the logging.
+    ######################################################################
+    def setMoveLog(self, move_log) -> None:
+        self._move_log = move_log
+        self._move_log_appenders = move_log.getAppenders() if move_log is not None else None
+
+    ######################################################################
+    ##  Switches the extruder on or off for the moves that follow
+    ######################################################################
+    def setExtruding(self, extruding: bool) -> None:
+        self._extruding = extruding
+        self._extrusion_position = self.getPosition() if extruding else None
+        self._active_rate = self._extrusion_rate if extruding else 0.0
+
+    def isExtruding(self) -> bool:
+        return self._extruding
+
+    ######################################################################
+    ##  Sets the extrusion rate in mm of filament per minute
+    ######################################################################
+    def setExtrusionRate(self, extrusion_rate: float) -> None:
+        self._extrusion_rate = extrusion_rate
+        if self._extruding:
+            # Moves made while the rate was 0 didn't move the extrusion position on
+            self._active_rate = extrusion_rate
+            self._extrusion_position = self.getPosition()
+
+    def getExtrusionRate(self) -> float:
+        return self._extrusion_rate
+
+    ######################################################################
+    ##  Returns the filament used since the last call, in mm
+    ######################################################################
+    def takeExtruded(self) -> float:
+        extruded = self.extruded
+        self.extruded = 0.0
+        return extruded
+
+    # Adds the filament used by the move to position, the new position, and logs the move
+    def _trackMove(self, position: List[float]) -> None:
+        if self._active_rate:
+            if self._feedrate > 0:
+                self.extruded += math.dist(position, self._extrusion_position) * self._active_rate / self._feedrate
+            self._extrusion_position = position
+        if self._move_log is not None:
+            append_x, append_y, append_z, append_feedrate = self._move_log_appenders
+            append_x(position[0])
+            append_y(position[1])
+            append_z(position[2])
+            append_feedrate(self._feedrate)
+
+    @staticmethod
+    def _numberPattern(precision: int) -> str:
+        # Matches numbers that float() parses and formatting writes back the same way, apart from trailing zeros
+        return r"(-?(?:0|[1-9][0-9]{0,8}))(\.[0-9]{0,%d})?" % precision
+
+    @staticmethod
+    def _createPadding(precision: int) -> List[bytes]:
+        # Zeros to add to a number, indexed by the length of its decimal part including the point
+        return [b"." + b"0" * precision] + [b"0" * (precision - decimals) for decimals in range(precision + 1)]
+
+    # Moves which don't look like Cura's are split into parameters and parsed in full
+    def _translateTokens(self, line: bytes) -> bytes:
+        feedrate = None
+        formatted = self._formatted
+        gcode_args = line.split(b" ")
+        for gcode_arg in gcode_args:
+            parameter = gcode_arg[:1]
+            if parameter == b"X":
+                formatted[0] = self._format_specs[0] % float(gcode_arg[1:])
+            elif parameter == b"Y":
+                formatted[1] = self._format_specs[1] % float(gcode_arg[1:])
+            elif parameter == b"Z":
+                formatted[2] = self._format_specs[2] % float(gcode_arg[1:])
+            elif parameter == b"F":
+                feedrate = float(gcode_arg[1:])
+                self._feedrate = round(feedrate, 1)
+
+        if self._active_rate or self._move_log is not None:
+            self._trackMove(self.getPosition())
+
+        line = self._template % (gcode_args[0], formatted[0], formatted[1], formatted[2])
+        if feedrate is not None:
+            line += b" F%.1f" % feedrate
+        return line
+
+    # Used when G_format isn't a plain template with fixed point coordinates
+    def _translateFormat(self, line: bytes) -> bytes:
+        feedrate = None
+        positions = self._positions
+        gcode_args = line.split(b" ")
+        for gcode_arg in gcode_args:
+            parameter = gcode_arg[:1]
+            if parameter == b"X":
+                positions[0] = float(gcode_arg[1:])
+            elif parameter == b"Y":
+                positions[1] = float(gcode_arg[1:])
+            elif parameter == b"Z":
+                positions[2] = float(gcode_arg[1:])
+            elif parameter == b"F":
+                feedrate = float(gcode_arg[1:])
+                self._feedrate = round(feedrate, 1)
+
+        if self._active_rate or self._move_log is not None:
+            self._trackMove(self.getPosition())
+
+        line = self._G_format.format(gcode_args[0].decode("utf-8"), positions[0], positions[1], positions[2])
+        if feedrate is not None:
+            line += " F{0:.1f}".format(feedrate)
+        return line.encode("utf-8")
+
+
+######################################################################
+##  Splits G_format into its literal text, the part before each field
+##  and the part after the last one, and the precision of the X, Y and
+##  Z coordinates. Returns None unless G_format uses each of its fields
+##  once in order with the coordinates formatted as fixed point numbers.
+######################################################################
+def parseMoveFormat(G_format: str) -> Optional[Tuple[List[bytes], List[int]]]:
+    literals = []
+    fields = []
+    try:
+        for literal, field_name, format_spec, conversion in Formatter().parse(G_format):
+            literals.append(literal.encode("utf-8"))
+            if field_name is not None:
+                fields.append((field_name, format_spec, conversion))
+    except ValueError:
+        return None
+
+    if [field[0] for field in fields] != ["0", "1", "2", "3"] or fields[0][1:] != ("", None):
+        return None
+    if len(literals) == len(fields):
+        literals.append(b"")
+
+    # Up to six decimals keeps the padded numbers within the 15 significant digits a float always round trips
+    precisions = []
+    for field_name, format_spec, conversion in fields[1:]:
+        spec = re.fullmatch(r"\.([1-6])f", format_spec)
+        if conversion is not None or spec is None:
+            return None
+        precisions.append(int(spec.group(1)))
+
+    return literals, precisions
@@ -0,0 +1,156 @@
+####################################################################
+#  MoveMerger for the CubeproWriter plugin
+#
+#  Shortens translated g-code by merging runs of consecutive moves that
+#  lie on one straight line, to within a tolerance, into a single move.
+#  Curved outlines of organic models are sliced into many very short
+#  moves, and the Cube printers have to read and plan every one of them.
+#  A move shorter than the tolerance is merged into the next one the
+#  same way, so segments the printer can't resolve are dropped.
+#
+#  The extruder of the BFB flavour runs at a set rate while it is on,
+#  so only moves with nothing between them are merged: a run ends at any
+#  other command, such as switching the extruder on or off or setting
+#  its rate, at a move which sets the feedrate and at a change of Z, so
+#  layers are never merged into each other. The header is left alone.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import math
+
+from typing import List, Optional, Tuple
+
+
+class MoveMerger:
+    # Longer runs are split so that checking each new move against the run stays quick
+    _max_run_length = 64
+
+    _moves = (b"G0", b"G1")
+
+    def __init__(self, tolerance: float, newline: bytes = b"\r\n") -> None:
+        # tolerance is how far in mm a merged move may pass from the end of any move it replaces
+        self._tolerance = tolerance
+        self._newline = newline
+
+        self._header_found = False
+        self._partial_line = b""
+
+        # The end of the last move written out, or None until it is known
+        self._position = None  # type: Optional[List[float]]
+
+        # The run of moves being merged: where it starts, the end of each move in it and the last move's line
+        self._run_start = None  # type: Optional[List[float]]
+        self._run_points = []  # type: List[List[float]]
+        self._run_line = b""
+
+        self._moves_read = 0
+        self._moves_written = 0
+
+    ######################################################################
+    ##  Returns translated g-code with its moves merged. The last move
+    ##  of data is held back until the next call or flush().
+    ######################################################################
+    def process(self, data: bytes) -> bytearray:
+        output = bytearray()
+        newline = self._newline
+        lines = (self._partial_line + data).split(newline)
+        self._partial_line = lines.pop()
+
+        for line in lines:
+            if not self._header_found:
+                output += line + newline
+                self._header_found = line == b"^InitComplete"
+            elif line[:2] in self._moves and line[2:3] == b" ":
+                self._addMove(line, output)
+            else:
+                self._endRun(output)
+                output += line + newline
+
+                # Anything else that moves the print head leaves its position unknown
+                if line[:1] == b"G" and line[:3] != b"G4 ":
+                    self._position = None
+        return output
+
+    ######################################################################
+    ##  Returns the moves still held back
+    ######################################################################
+    def flush(self) -> bytearray:
+        output = bytearray()
+        self._endRun(output)
+        if self._partial_line:
+            output += self._partial_line
+            self._partial_line = b""
+        return output
+
+    ######################################################################
+    ##  Returns the number of moves read and written so far
+    ######################################################################
+    def getMoveCounts(self) -> Tuple[int, int]:
+        return self._moves_read, self._moves_written
+
+    def _addMove(self, line: bytes, output: bytearray) -> None:
+        self._moves_read += 1
+        gcode_args = line.split(b" ")
+        point = list(self._position) if self._position is not None else [None, None, None]
+        sets_feedrate = False
+        for gcode_arg in gcode_args[1:]:
+            parameter = gcode_arg[:1]
+            if parameter == b"X":
+                point[0] = float(gcode_arg[1:])
+            elif parameter == b"Y":
+                point[1] = float(gcode_arg[1:])
+            elif parameter == b"Z":
+                point[2] = float(gcode_arg[1:])
+            elif parameter == b"F":
+                sets_feedrate = True
+
+        if self._run_start is not None and not sets_feedrate and line[:2] == self._run_line[:2] and point[2] == self._run_start[2] \
+                and len(self._run_points) < self._max_run_length and self._isOnLine(self._run_start, point):
+            self._run_points.append(point)
+            self._run_line = line
+            return
+
+        self._endRun(output)
+
+        # A move which sets the feedrate or changes Z is written as it is and can only start a run after it
+        if sets_feedrate or self._position is None or None in point or point[2] != self._position[2]:
+            output += line + self._newline
+            self._moves_written += 1
+            self._position = point if None not in point else None
+            return
+
+        self._run_start = self._position
+        self._run_points = [point]
+        self._run_line = line
+
+    # Writes the last move of the run, which takes the place of all of them
+    def _endRun(self, output: bytearray) -> None:
+        if self._run_start is None:
+            return
+        output += self._run_line + self._newline
+        self._moves_written += 1
+        self._position = self._run_points[-1]
+        self._run_start = None
+        self._run_points = []
+
+    # Whether the end of every move of the run is within the tolerance of the move from start to end
+    def _isOnLine(self, start: List[float], end: List[float]) -> bool:
+        tolerance = self._tolerance
+        dx = end[0] - start[0]
+        dy = end[1] - start[1]
+        length_squared = dx * dx + dy * dy
+        for point in self._run_points:
+            px = point[0] - start[0]
+            py = point[1] - start[1]
+
+            # The nearest point of the move, so that a run which doubles back isn't merged
+            t = (px * dx + py * dy) / length_squared if length_squared else 0.0
+            t = min(1.0, max(0.0, t))
+            if math.hypot(px - t * dx, py - t * dy) > tolerance:
+                return False
+        return True
@@ -0,0 +1,145 @@
+####################################################################
+#  ParallelEncryptor for the CubeproWriter plugin
+#
+#  The Cube print file formats use Blowfish in ECB mode so every 8 byte
+#  block can be encrypted independently. Large print files are split
+#  into block aligned chunks which are encrypted in place by a pool of
+#  worker processes through shared memory, and written out in order.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import os
+import sys
+
+from multiprocessing import shared_memory
+from typing import Dict, Optional
+
+from .blowfish import Blowfish
+from . import WorkerPool
+
+
+class ParallelEncryptor:
+    def __init__(self, workers: Optional[int] = None, threshold: int = 32 * 1024 * 1024, chunk_size: int = 4 * 1024 * 1024) -> None:
+        # Buffers smaller than threshold are encrypted serially since starting the worker processes costs more
+        # than it saves. chunk_size is rounded down to whole cipher blocks.
+        self._workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._threshold = threshold
+        self._chunk_size = max(8, chunk_size - chunk_size % 8)
+
+        self._enabled = True
+        self._pool = None
+
+    def setEnabled(self, enabled: bool) -> None:
+        self._enabled = enabled
+
+    def getThreshold(self) -> int:
+        return self._threshold
+
+    ######################################################################
+    ##  Returns False when worker processes can't or shouldn't be used. A
+    ##  frozen Cura build would start a new instance of the application
+    ##  for each spawned worker.
+    ######################################################################
+    def isSupported(self) -> bool:
+        return self._enabled and self._workers > 1 and not getattr(sys, "frozen", False)
+
+    ######################################################################
+    ##  Shuts down the worker processes. They are started on the first
+    ##  parallel call and kept for later calls until this is called, so
+    ##  an export that encrypts in several batches only starts them once.
+    ######################################################################
+    def stop(self) -> None:
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    ######################################################################
+    ##  Encrypts data, which must be a whole number of blocks long, and
+    ##  writes the result to stream in writes of at most write_size bytes.
+    ##  Returns the number of worker processes used, 0 when it was
+    ##  encrypted serially.
+    ######################################################################
+    def encryptToStream(self, cipher: Blowfish, data, stream, compatibility_mode: bool = False, write_size: int = 64 * 1024) -> int:
+        data = memoryview(data).cast("B")
+        if len(data) % 8:
+            raise RuntimeError("Attempted to encrypt data of invalid length: %s" % len(data))
+
+        workers = min(self._workers, -(-len(data) // self._chunk_size))
+        if len(data) < self._threshold or workers < 2 or not self.isSupported():
+            self._encryptSerially(cipher, data, stream, compatibility_mode, write_size)
+            return 0
+
+        try:
+            shm = shared_memory.SharedMemory(create = True, size = len(data))
+        except OSError:
+            self._encryptSerially(cipher, data, stream, compatibility_mode, write_size)
+            return 0
+
+        try:
+            shm.buf[:len(data)] = data
+            schedule = cipher.schedule()
+            tasks = [(shm.name, start, min(start + self._chunk_size, len(data)), compatibility_mode, schedule, cipher.key)
+                     for start in range(0, len(data), self._chunk_size)]
+
+            written = 0
+            try:
+                if self._pool is None:
+                    self._pool = WorkerPool.createPool(self._workers)
+
+                # imap returns the chunks in order as they complete so that writing overlaps with encryption
+                for start, end in WorkerPool.imapWithTimeout(self._pool, _encryptSharedChunk, tasks):
+                    _writeChunked(stream, shm.buf[start:end], write_size)
+                    written = end
+            except Exception:
+                # Workers couldn't be started, died or stopped answering, so finish off whatever is left serially
+                self.stop()
+                self._encryptSerially(cipher, data[written:], stream, compatibility_mode, write_size)
+                return 0
+
+            return workers
+        finally:
+            shm.close()
+            shm.unlink()
+
+    @staticmethod
+    def _encryptSerially(cipher: Blowfish, data, stream, compatibility_mode: bool, write_size: int) -> None:
+        _writeChunked(stream, memoryview(cipher.encrypt_blocks(data, compatibility_mode)), write_size)
+
+
+def _writeChunked(stream, data: memoryview, write_size: int) -> None:
+    for start in range(0, len(data), write_size):
+        stream.write(data[start:start + write_size])
+
+
+# Ciphers built from a key schedule in this worker process, keyed by their P-array
+_worker_ciphers = {}  # type: Dict[tuple, Blowfish]
+
+
+def _encryptSharedChunk(task):
+    name, start, end, compatibility_mode, schedule, key = task
+
+    cache_key = tuple(schedule[0])
+    cipher = _worker_ciphers.get(cache_key)
+    if cipher is None:
+        cipher = Blowfish.from_schedule(*schedule, key = key)
+        _worker_ciphers[cache_key] = cipher
+
+    shm = _attachSharedMemory(name)
+    try:
+        shm.buf[start:end] = cipher.encrypt_blocks(shm.buf[start:end], compatibility_mode)
+    finally:
+        shm.close()
+    return start, end
+
+
+def _attachSharedMemory(name: str) -> shared_memory.SharedMemory:
+    # Workers share the resource tracker of the parent which owns and unlinks the segment
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name = name, track = False)
+    return shared_memory.SharedMemory(name = name)
@@ -0,0 +1,155 @@
+####################################################################
+#  ParallelTranslator for the CubeproWriter plugin
+#
+#  Translates large batches of Cura g-code on all cores. Once the
+#  header has been found the only state carried from one line to the
+#  next is the active extruder, its settings and the position, so the
+#  batch is split at ;LAYER: markers and the state at the start of each
+#  chunk is found with a cheap scan of the chunks before it. The chunks
+#  are then translated by a pool of worker processes and joined in
+#  order, giving exactly the same g-code as translating them one after
+#  another. The layers, filament and print time counted by each worker
+#  are added up for the header. Each chunk's print time is estimated
+#  with the extruders already at the temperatures last set before it,
+#  so the ^Time written to the header can differ slightly from that of
+#  a serial translation when a chunk starts while one is heating up.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import os
+import sys
+
+from typing import Dict, List, Optional, Tuple
+
+from .GCodeTranslator import GCodeTranslator
+from . import WorkerPool
+
+
+class ParallelTranslator:
+    # Cura starts each layer with a comment line like ;LAYER:12
+    _layer_marker = b"\n;LAYER:"
+
+    def __init__(self, workers: Optional[int] = None, threshold: int = 16 * 1024 * 1024, chunk_size: int = 1024 * 1024) -> None:
+        # Batches smaller than threshold are translated serially since starting the worker processes costs more
+        # than it saves. Chunks are at least chunk_size bytes of g-code, ending at a layer marker.
+        self._workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._threshold = threshold
+        self._chunk_size = chunk_size
+
+        self._enabled = True
+        self._pool = None
+
+    def setEnabled(self, enabled: bool) -> None:
+        self._enabled = enabled
+
+    def getThreshold(self) -> int:
+        return self._threshold
+
+    ######################################################################
+    ##  Returns False when worker processes can't or shouldn't be used. A
+    ##  frozen Cura build would start a new instance of the application
+    ##  for each spawned worker.
+    ######################################################################
+    def isSupported(self) -> bool:
+        return self._enabled and self._workers > 1 and not getattr(sys, "frozen", False)
+
+    ######################################################################
+    ##  Shuts down the worker processes. They are started on the first
+    ##  parallel call and kept for later calls until this is called.
+    ######################################################################
+    def stop(self) -> None:
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    ######################################################################
+    ##  Translates data, whole lines of g-code separated by newlines, and
+    ##  appends the result to output. The translator is left in the state
+    ##  it would have after translating data itself. Returns the number
+    ##  of chunks translated by worker processes, 0 when it was all
+    ##  translated serially.
+    ######################################################################
+    def translate(self, translator: GCodeTranslator, data: bytes, output: bytearray) -> int:
+        if len(data) < self._threshold or not self.isSupported():
+            translator.translate(data.split(b"\n"), output)
+            return 0
+
+        # Lines before the header is complete are buffered by the translator, so translate up to the first layer
+        # serially until it has been found
+        if not translator.canScan():
+            first_layer = data.find(self._layer_marker)
+            if first_layer < 0:
+                translator.translate(data.split(b"\n"), output)
+                return 0
+            translator.translate(data[:first_layer].split(b"\n"), output)
+            data = data[first_layer + 1:]
+            if not translator.canScan():
+                translator.translate(data.split(b"\n"), output)
+                return 0
+
+        bounds = self._splitLayers(data)
+        if len(bounds) < 2:
+            translator.translate(data.split(b"\n"), output)
+            return 0
+
+        # The prefix scan: the state at the start of each chunk is the state at the end of the one before it
+        settings = translator.getSettings()
+        states = []
+        for start, end in bounds:
+            states.append(translator.getState())
+            translator.scan(data[start:end])
+        end_state = translator.getState()
+
+        tasks = [(settings, state, data[start:end]) for state, (start, end) in zip(states, bounds)]
+
+        translated = 0
+        try:
+            if self._pool is None:
+                self._pool = WorkerPool.createPool(self._workers)
+
+            # imap returns the chunks in order as they complete
+            for chunk_output, totals in WorkerPool.imapWithTimeout(self._pool, _translateChunk, tasks):
+                output += chunk_output
+                translator.addTotals(totals)
+                translated += 1
+        except Exception:
+            # Workers couldn't be started, died or stopped answering, so finish off whatever is left serially. A
+            # translation error is raised again by translating the chunk here.
+            self.stop()
+            translator.setState(states[translated])
+            translator.translate(data[bounds[translated][0]:].split(b"\n"), output)
+            return 0
+
+        translator.setState(end_state)
+        return len(tasks)
+
+    def _splitLayers(self, data: bytes) -> List[Tuple[int, int]]:
+        # Each chunk is at least chunk_size bytes long and ends just before a layer marker, apart from the last
+        bounds = []
+        start = 0
+        while True:
+            end = data.find(self._layer_marker, start + self._chunk_size)
+            if end < 0:
+                break
+            bounds.append((start, end))
+            start = end + 1
+        bounds.append((start, len(data)))
+        return bounds
+
+
+# Returns the translated chunk with the layers, filament and print time counted in it
+def _translateChunk(task) -> Tuple[bytes, Tuple[int, Dict[int, float], float]]:
+    settings, state, data = task
+
+    translator = GCodeTranslator(**settings)
+    translator.setState(state)
+
+    output = bytearray()
+    translator.translate(data.split(b"\n"), output)
+    return bytes(output), translator.getTotals()
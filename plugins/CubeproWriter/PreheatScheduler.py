@@ -0,0 +1,180 @@
+####################################################################
+#  PreheatScheduler for the CubeproWriter plugin
+#
+#  On the CubePro Duo/Trio and CubeX Duo/Trio every tool change is
+#  followed by M109 T<n>, which the translator turns into a blocking
+#  M<n>04 S<temp>, so the printer stands still while the next nozzle
+#  heats up. This pass goes over the translated g-code and starts the
+#  heating earlier with a non-blocking M<n>04 S<temp> P1, so that the
+#  blocking command which follows only tops the temperature up.
+#
+#  The extruder is taken to be at the temperature it was last set to
+#  and to heat up at a constant rate, which gives how long before the
+#  wait the preheat is needed. It is never moved further back than the
+#  configured preheat time, nor past the last time the extruder was
+#  switched on or had its temperature set. Moves are timed by their
+#  length over their feedrate and pauses by their length. To do this
+#  the output is held back by up to the preheat time.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import math
+import re
+
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+class PreheatScheduler:
+    # The extruders start out cold
+    _room_temperature = 20
+
+    # Matches a translated extruder temperature command, M104, M204 or M304, and its P1 if it doesn't wait
+    _temperature_match = re.compile(rb"M([1-9])04 S(-?[0-9]+)( P1)?").fullmatch
+
+    # Cura's BFB flavour switches extruders 1, 2 and 3 on with M101, M201 and M301
+    _extruder_on_match = re.compile(rb"M([1-9])01(?: .*)?").fullmatch
+
+    def __init__(self, preheat_time: float, heat_up_speed: float, newline: bytes = b"\r\n") -> None:
+        # preheat_time is the longest time in seconds a preheat is moved ahead of its wait, heat_up_speed is how fast the
+        # extruders heat up in degrees C/s
+        self._preheat_time = preheat_time
+        self._heat_up_speed = heat_up_speed
+        self._newline = newline
+
+        self._header_found = False
+        self._partial_line = b""
+
+        # The lines held back, each with the time the printer takes over it
+        self._lines = deque()  # type: Deque[List]
+        self._held_time = 0.0
+
+        # The position and feedrate the moves are timed from, and the temperature each extruder was last set to
+        self._position = None  # type: Optional[List[float]]
+        self._feedrate = 0.0
+        self._temperatures = {}  # type: Dict[int, int]
+
+        self._preheats = 0
+        self._saved_time = 0.0
+
+    ######################################################################
+    ##  Returns translated g-code with the preheats added, holding back
+    ##  the lines which may still get one ahead of them
+    ######################################################################
+    def process(self, data: bytes) -> bytearray:
+        output = bytearray()
+        newline = self._newline
+        lines = (self._partial_line + data).split(newline)
+        self._partial_line = lines.pop()
+
+        for line in lines:
+            match = self._temperature_match(line)
+            if match is not None:
+                extruder_num = int(match.group(1))
+                temperature = int(match.group(2))
+                if match.group(3) is None and self._header_found:
+                    self._schedulePreheat(extruder_num, temperature)
+                self._temperatures[extruder_num] = temperature
+
+            # The temperatures set in the header are followed but nothing is added to it
+            if not self._header_found:
+                output += line + newline
+                self._header_found = line == b"^InitComplete"
+                continue
+
+            self._lines.append([line, self._getDuration(line), match is not None or self._extruder_on_match(line) is not None])
+            self._held_time += self._lines[-1][1]
+            self._release(output, self._preheat_time)
+        return output
+
+    ######################################################################
+    ##  Returns the lines still held back
+    ######################################################################
+    def flush(self) -> bytearray:
+        output = bytearray()
+        while self._lines:
+            output += self._lines.popleft()[0] + self._newline
+        self._held_time = 0.0
+        if self._partial_line:
+            output += self._partial_line
+            self._partial_line = b""
+        return output
+
+    ######################################################################
+    ##  Returns the number of preheats added and the heating time they
+    ##  take off the waits, in seconds
+    ######################################################################
+    def getStatistics(self) -> Tuple[int, float]:
+        return self._preheats, self._saved_time
+
+    # Adds a non-blocking temperature command ahead of a wait for extruder_num to heat up to temperature, early enough
+    # for it to have heated up by the time of the wait if the lines held back allow
+    def _schedulePreheat(self, extruder_num: int, temperature: int) -> None:
+        heat_up_time = (temperature - self._temperatures.get(extruder_num, self._room_temperature)) / self._heat_up_speed
+        if heat_up_time <= 0:
+            return
+
+        lead_time = 0.0
+        index = len(self._lines)
+        while index > 0 and lead_time < heat_up_time:
+            line, duration, uses_extruder = self._lines[index - 1]
+            if uses_extruder and self._usesExtruder(line, extruder_num):
+                break
+            lead_time += duration
+            index -= 1
+
+        if lead_time <= 0:
+            return
+        self._lines.insert(index, [b"M%d04 S%d P1" % (extruder_num, temperature), 0.0, True])
+        self._preheats += 1
+        self._saved_time += min(lead_time, heat_up_time)
+
+    @staticmethod
+    def _usesExtruder(line: bytes, extruder_num: int) -> bool:
+        return line[1:2] == b"%d" % extruder_num
+
+    # Passes on the oldest lines until no more than keep_time is held back
+    def _release(self, output: bytearray, keep_time: float) -> None:
+        lines = self._lines
+        while lines and self._held_time - lines[0][1] >= keep_time:
+            line, duration, uses_extruder = lines.popleft()
+            self._held_time -= duration
+            output += line + self._newline
+
+    # How long the printer takes over a line, going by the feedrate for moves and the pause for G4. Heating up is left
+    # out as the waits are what is being shortened.
+    def _getDuration(self, line: bytes) -> float:
+        command = line[:3]
+        if command in (b"G0 ", b"G1 "):
+            position = list(self._position) if self._position is not None else None
+            for gcode_arg in line.split(b" ")[1:]:
+                parameter = gcode_arg[:1]
+                if parameter == b"F":
+                    self._feedrate = float(gcode_arg[1:])
+                elif position is not None and parameter in (b"X", b"Y", b"Z"):
+                    position[b"XYZ".index(parameter)] = float(gcode_arg[1:])
+
+            duration = 0.0
+            if self._position is not None and self._feedrate > 0:
+                duration = math.dist(position, self._position) * 60 / self._feedrate
+            self._position = position if position is not None else self._parsePosition(line)
+            return duration
+
+        if command == b"G4 ":
+            for gcode_arg in line.split(b" ")[1:]:
+                if gcode_arg[:1] in (b"P", b"S"):
+                    return float(gcode_arg[1:])
+        return 0.0
+
+    # The first move sets the position the others are timed from, if it has all of X, Y and Z
+    @staticmethod
+    def _parsePosition(line: bytes) -> Optional[List[float]]:
+        position = {gcode_arg[:1]: float(gcode_arg[1:]) for gcode_arg in line.split(b" ")[1:] if gcode_arg[:1] in (b"X", b"Y", b"Z")}
+        if len(position) != 3:
+            return None
+        return [position[b"X"], position[b"Y"], position[b"Z"]]
@@ -0,0 +1,188 @@
+####################################################################
+#  PrintTimeEstimator for the CubeproWriter plugin
+#
+#  Estimates how long the printer takes over the translated g-code,
+#  for the ^Time header field. Each move accelerates from the speed
+#  it can take a corner at up to its feedrate, capped by the feedrate
+#  and acceleration limits of each axis, and slows down again at its
+#  end. Pauses and waits for the extruders to heat up are added to the
+#  time of the moves.
+#
+#  The limits come from the cube_machine_limits metadata entry of the
+#  printer definitions, which is kept apart from Cura's own machine
+#  settings so that slicing isn't affected by it. Moves are added in
+#  batches, along with the pauses and temperature changes between them,
+#  usually as the columns MoveCodec logs them to, and are worked through
+#  with NumPy when it is available.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import itertools
+import math
+
+from typing import Dict, List, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class PrintTimeEstimator:
+    # The extruders start out cold
+    _room_temperature = 20.0
+
+    def __init__(self, limits: Dict) -> None:
+        # limits holds the "max_feedrate" (mm/s) and "max_acceleration" (mm/s^2) of the X, Y and Z axes, the
+        # "acceleration" of the print head (mm/s^2), the "jerk", the speed it can change direction at without slowing
+        # down (mm/s), and the "heat_up_speed" and "cool_down_speed" of the extruders (degrees C/s)
+        self._max_feedrate = [float(value) for value in limits["max_feedrate"]]
+        self._max_acceleration = [float(value) for value in limits["max_acceleration"]]
+        self._acceleration = float(limits["acceleration"])
+        self._jerk = float(limits["jerk"])
+        self._heat_up_speed = float(limits["heat_up_speed"])
+        self._cool_down_speed = float(limits["cool_down_speed"])
+
+        self._position = [0.0, 0.0, 0.0]
+        self._clock = 0.0
+        self._taken = 0.0
+
+        # The temperature of each extruder when it was last set, its target and when it was set
+        self._heaters = {}  # type: Dict[int, List[float]]
+
+    def setPosition(self, position: Sequence[float]) -> None:
+        self._position = [float(value) for value in position]
+
+    ######################################################################
+    ##  Adds moves from the current position through points, each a row
+    ##  of X, Y and Z, at feedrates in mm/min. A feedrate of 0 means the
+    ##  move runs as fast as the axes allow. events are made between the
+    ##  moves, each a tuple of the number of moves before it, a method of
+    ##  the estimator such as addDwell and the arguments to call it with.
+    ######################################################################
+    def addMoves(self, points, feedrates, events: Sequence[Tuple] = ()) -> None:
+        # The time at the end of each move from the start of the first
+        if len(points) == 0:
+            elapsed = [0.0]
+        elif numpy is not None:
+            elapsed = numpy.cumsum(self._getMoveTimes(numpy.asarray(points, dtype = float), numpy.asarray(feedrates, dtype = float)))
+        else:
+            starts = [self._position] + list(points[:-1])
+            elapsed = list(itertools.accumulate(self._getMoveTime(start, point, feedrate) for start, point, feedrate in zip(starts, points, feedrates)))
+
+        start = self._clock
+        added = 0.0
+        for index, method, arguments in events:
+            self._clock = start + (float(elapsed[index - 1]) if index else 0.0) + added
+            before = self._clock
+            method(*arguments)
+            added += self._clock - before
+
+        self._clock = start + float(elapsed[-1]) + added
+        if len(points):
+            self._position = [float(value) for value in points[-1]]
+
+    ######################################################################
+    ##  Adds the moves of a ColumnarMoves.MoveColumns, logged by
+    ##  MoveCodec, and the events between them as addMoves() does
+    ######################################################################
+    def addMoveColumns(self, columns, events: Sequence[Tuple] = ()) -> None:
+        if not columns:
+            self.addMoves([], [], events)
+        else:
+            self.addMoves(columns.getPoints(), columns.getFeedrates(), events)
+
+    def addDwell(self, seconds: float) -> None:
+        self._clock += seconds
+
+    ######################################################################
+    ##  Sets the target temperature of an extruder, numbered from 1. With
+    ##  wait the printer waits until the extruder has reached it.
+    ######################################################################
+    def setTemperature(self, extruder: int, temperature: float, wait: bool) -> None:
+        current = self._getTemperature(extruder)
+        self._heaters[extruder] = [current, float(temperature), self._clock]
+        if wait:
+            speed = self._heat_up_speed if temperature > current else self._cool_down_speed
+            self._clock += abs(temperature - current) / speed
+            self._heaters[extruder] = [float(temperature), float(temperature), self._clock]
+
+    ######################################################################
+    ##  Returns the target temperature of each extruder which has one
+    ######################################################################
+    def getTargets(self) -> Dict[int, float]:
+        return {extruder: heater[1] for extruder, heater in self._heaters.items()}
+
+    ######################################################################
+    ##  Sets the target temperatures of the extruders, taking them to
+    ##  have reached them already
+    ######################################################################
+    def setTargets(self, targets: Dict[int, float]) -> None:
+        self._heaters = {}
+        for extruder, target in targets.items():
+            self.settleTemperature(extruder, target)
+
+    def settleTemperature(self, extruder: int, temperature: float) -> None:
+        self._heaters[extruder] = [float(temperature), float(temperature), self._clock]
+
+    ######################################################################
+    ##  Returns the time added since the last call, in seconds
+    ######################################################################
+    def takeTime(self) -> float:
+        taken = self._clock - self._taken
+        self._taken = self._clock
+        return taken
+
+    def _getTemperature(self, extruder: int) -> float:
+        heater = self._heaters.get(extruder)
+        if heater is None:
+            return self._room_temperature
+
+        temperature, target, start = heater
+        elapsed = self._clock - start
+        if target > temperature:
+            return min(target, temperature + self._heat_up_speed * elapsed)
+        return max(target, temperature - self._cool_down_speed * elapsed)
+
+    def _getMoveTimes(self, points, feedrates):
+        deltas = numpy.abs(numpy.diff(numpy.vstack((self._position, points)), axis = 0))
+        lengths = numpy.sqrt(numpy.einsum("ij,ij->i", deltas, deltas))
+
+        # Moves that go nowhere take no time, and come out as nan before they are left out at the end
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            # Each axis limits the speed and acceleration along the move by the share of the move it makes
+            shares = deltas / lengths[:, None]
+            speeds = numpy.min(numpy.array(self._max_feedrate) / shares, axis = 1)
+            accelerations = numpy.minimum(self._acceleration, numpy.min(numpy.array(self._max_acceleration) / shares, axis = 1))
+            speeds = numpy.where(feedrates > 0, numpy.minimum(feedrates / 60, speeds), speeds)
+
+            # A trapezoid from the corner speed up to the speed and back down, or a triangle if the move is too short
+            corner_speeds = numpy.minimum(speeds, self._jerk)
+            ramp_lengths = (speeds ** 2 - corner_speeds ** 2) / (2 * accelerations)
+            peak_speeds = numpy.sqrt(corner_speeds ** 2 + accelerations * lengths)
+            times = numpy.where(lengths >= 2 * ramp_lengths,
+                                2 * (speeds - corner_speeds) / accelerations + (lengths - 2 * ramp_lengths) / speeds,
+                                2 * (peak_speeds - corner_speeds) / accelerations)
+        return numpy.where(lengths > 0, times, 0.0)
+
+    def _getMoveTime(self, start: Sequence[float], end: Sequence[float], feedrate: float) -> float:
+        deltas = [abs(b - a) for a, b in zip(start, end)]
+        length = math.sqrt(sum(delta * delta for delta in deltas))
+        if length == 0:
+            return 0.0
+
+        speed = min(limit * length / delta for limit, delta in zip(self._max_feedrate, deltas) if delta)
+        acceleration = min([self._acceleration] + [limit * length / delta for limit, delta in zip(self._max_acceleration, deltas) if delta])
+        if feedrate > 0:
+            speed = min(speed, feedrate / 60)
+
+        corner_speed = min(speed, self._jerk)
+        ramp_length = (speed ** 2 - corner_speed ** 2) / (2 * acceleration)
+        if length >= 2 * ramp_length:
+            return 2 * (speed - corner_speed) / acceleration + (length - 2 * ramp_length) / speed
+        return 2 * (math.sqrt(corner_speed ** 2 + acceleration * length) - corner_speed) / acceleration
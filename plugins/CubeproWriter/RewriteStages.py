@@ -0,0 +1,136 @@
+####################################################################
+#  RewriteStages for the CubeproWriter plugin
+#
+#  Lets other plugins rewrite the g-code of the Cube writers as it is
+#  exported, without another pass over the whole job the way Cura's
+#  post-processing scripts need. A rewrite stage is given the translated
+#  g-code a layer at a time, each command split into its words, and
+#  yields the commands to write instead. The stages are chained inside
+#  the export's own streaming pass, each taking what the one before it
+#  yields, ahead of the built-in passes.
+#
+#  A stage is a subclass of RewriteStage and is registered with the
+#  CubeproWriter plugin object, which creates a new one for every
+#  export:
+#
+#      class PurgeStage(RewriteStage):
+#          def rewrite(self, layer, commands):
+#              if layer == 0:
+#                  commands = [[b"G1", b"X0.000", b"Y0.000", b"Z0.3000"]] + commands
+#              yield commands
+#
+#      writer = PluginRegistry.getInstance().getPluginObject("CubeproWriter")
+#      writer.addRewriteStage(PurgeStage)
+#
+#  The header, up to ^InitComplete, is passed on as it is. The commands
+#  after it and before the first layer are given with a layer of None.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+from typing import Iterable, List, Optional, Sequence
+
+from .GCodeTranslator import GCodeTranslationError
+
+
+class RewriteStage:
+    ######################################################################
+    ##  Called with the commands of each layer in turn, layer being the
+    ##  number Cura gave it. Each command is a list of its words as bytes,
+    ##  the first being the command itself. Yields lists of commands to
+    ##  pass on in their place, and may hold commands back for a later
+    ##  layer. Passes the layer on unchanged unless overridden.
+    ######################################################################
+    def rewrite(self, layer: Optional[int], commands: List[List[bytes]]) -> Iterable[List[List[bytes]]]:
+        yield commands
+
+    ######################################################################
+    ##  Called after the last layer. Yields any commands still held back.
+    ######################################################################
+    def finish(self) -> Iterable[List[List[bytes]]]:
+        return ()
+
+
+class RewriteStageRunner:
+    # An output pass for GCodeLineSink that splits the translated g-code into layers at the markers the translator keeps
+    # for it, runs the layers through the stages and writes out what comes of them. The markers aren't written out.
+    _layer_marker = b";LAYER:"
+
+    def __init__(self, stages: Sequence[RewriteStage], plugin_name: str, newline: bytes = b"\r\n") -> None:
+        self._stages = list(stages)
+        self._plugin_name = plugin_name
+        self._newline = newline
+
+        self._header_found = False
+        self._partial_line = b""
+
+        # The layer being collected and its commands
+        self._layer = None  # type: Optional[int]
+        self._commands = []  # type: List[List[bytes]]
+
+    ######################################################################
+    ##  Returns the rewritten g-code of the layers completed by data
+    ######################################################################
+    def process(self, data: bytes) -> bytearray:
+        output = bytearray()
+        lines = (self._partial_line + data).split(self._newline)
+        self._partial_line = lines.pop()
+
+        for line in lines:
+            if not self._header_found:
+                output += line + self._newline
+                self._header_found = line == b"^InitComplete"
+            elif line.startswith(self._layer_marker):
+                self._rewriteLayer(output)
+                try:
+                    self._layer = int(line[len(self._layer_marker):])
+                except ValueError:
+                    self._layer = None
+            else:
+                self._commands.append(line.split(b" "))
+        return output
+
+    ######################################################################
+    ##  Returns the rewritten g-code of the last layer and whatever the
+    ##  stages still held back
+    ######################################################################
+    def flush(self) -> bytearray:
+        output = bytearray()
+        if self._partial_line:
+            self._commands.append(self._partial_line.split(b" "))
+            self._partial_line = b""
+        self._rewriteLayer(output)
+
+        for index, stage in enumerate(self._stages):
+            for commands in self._run(stage, stage.finish):
+                self._rewrite(index + 1, commands, output)
+        return output
+
+    def _rewriteLayer(self, output: bytearray) -> None:
+        commands = self._commands
+        self._commands = []
+        if commands or self._layer is not None:
+            self._rewrite(0, commands, output)
+
+    # Passes commands through the stages from first_stage on and writes out what comes of them
+    def _rewrite(self, first_stage: int, commands: List[List[bytes]], output: bytearray) -> None:
+        if first_stage == len(self._stages):
+            newline = self._newline
+            for command in commands:
+                output += b" ".join(command) + newline
+            return
+
+        stage = self._stages[first_stage]
+        for rewritten in self._run(stage, stage.rewrite, self._layer, commands):
+            self._rewrite(first_stage + 1, rewritten, output)
+
+    # Calls a method of a stage, turning anything it raises into an error the writer reports
+    def _run(self, stage: RewriteStage, method, *arguments) -> List[List[List[bytes]]]:
+        try:
+            return list(method(*arguments))
+        except Exception as e:
+            raise GCodeTranslationError(self._plugin_name + " - Rewrite stage " + type(stage).__name__ + " failed: " + str(e)) from e
@@ -0,0 +1,52 @@
+####################################################################
+#  SceneGCodeSource for the CubeproWriter plugin
+#
+#  Feeds the g-code Cura holds for the active build plate, one chunk
+#  (usually a layer) at a time, straight into a stream. It can be used
+#  in place of the GCodeWriter plugin, which writes the same chunks but
+#  also serializes the whole profile into ;SETTING_3 comment lines at
+#  the end, which the Cube writers skip anyway.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+from typing import List, Optional
+
+from cura.CuraApplication import CuraApplication
+
+
+class SceneGCodeSource:
+    def __init__(self, gcode_list: List[str]) -> None:
+        self._gcode_list = gcode_list
+
+    ######################################################################
+    ##  Returns a source for the g-code of the active build plate, or None
+    ##  when the scene holds none and GCodeWriter has to be used instead
+    ######################################################################
+    @classmethod
+    def forActiveBuildPlate(cls) -> Optional["SceneGCodeSource"]:
+        application = CuraApplication.getInstance()
+        gcode_dict = getattr(application.getController().getScene(), "gcode_dict", None)
+        if not gcode_dict:
+            return None
+
+        gcode_list = gcode_dict.get(application.getMultiBuildPlateModel().activeBuildPlate)
+        if not gcode_list:
+            return None
+        return cls(gcode_list)
+
+    ######################################################################
+    ##  Writes the g-code chunks to stream in order. Has the same
+    ##  signature as GCodeWriter.write() so either can be used.
+    ######################################################################
+    def write(self, stream, nodes) -> bool:
+        for gcode in self._gcode_list:
+            stream.write(gcode)
+        return True
+
+    def getInformation(self) -> str:
+        return ""
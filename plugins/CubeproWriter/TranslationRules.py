@@ -0,0 +1,102 @@
+####################################################################
+#  TranslationRules for the CubeproWriter plugin
+#
+#  The differences between the Cube printers in how Cura's g-code is
+#  translated for them are declared in the metadata of their printer
+#  definitions, as a table like this one:
+#
+#      "cube_translation_rules": {
+#          "G_format": "{0} X{1:.3f} Y{2:.3f} Z{3:.4f}",
+#          "M104_P_support": true,
+#          "gcode_M240_param": {"PLA": 2000, "ABS": 1400},
+#          "chamber_temperature": {"set": "M141", "command": "M404"}
+#      }
+#
+#  G_format is the template moves are written with. M104_P_support
+#  tells whether the printer takes P1 on M104 to set a temperature
+#  without waiting for it. gcode_M240_param maps the material of the
+#  first extruder to the S parameter of M240. chamber_temperature names
+#  the command that sets the chamber temperature, optionally the one
+#  that waits for it, and the one the printer uses instead, or is null
+#  to leave them as they are.
+#
+#  The definitions are the only place the rules of each printer are
+#  kept. Every entry is optional, and those left out, or the whole
+#  table for a printer without one, take the values of default_rules,
+#  which suit every Cube printer.
+#
+#  The table is checked and compiled into a plan once for each printer,
+#  and GCodeTranslator builds its rewrite rules from the plan.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+from typing import Dict, Optional
+
+# The name of the metadata entry of a printer definition which holds the table
+metadata_key = "cube_translation_rules"
+
+# The rules of a printer whose definition leaves them out, compiled. These are the rules of the Cube and Cube 2: moves
+# at the precision all of the printers take, a pause after setting a temperature rather than P1, M240 left as it is and
+# the chamber temperature set with M404.
+default_rules = {
+    "G_format": "{0} X{1:.3f} Y{2:.3f} Z{3:.3f}",
+    "M104_P_support": False,
+    "gcode_M240_param": {},
+    "chamber_temperature": {"set": b"M141", "command": b"M404"}
+}
+
+
+######################################################################
+##  Checks a rule table and returns the plan compiled from it, a dict
+##  holding every rule with the commands encoded as bytes, and the
+##  defaults for those left out. Raises ValueError if an entry isn't
+##  valid.
+######################################################################
+def compileRules(rules: Optional[Dict]) -> Dict:
+    if rules is None:
+        return dict(default_rules)
+    if not isinstance(rules, dict):
+        raise ValueError("The translation rules must be a table")
+
+    unknown = set(rules) - {"G_format", "M104_P_support", "gcode_M240_param", "chamber_temperature"}
+    if unknown:
+        raise ValueError("Unknown translation rules: " + ", ".join(sorted(unknown)))
+
+    plan = dict(default_rules)
+    if "G_format" in rules:
+        G_format = rules["G_format"]
+        try:
+            G_format.format("G1", 0.0, 0.0, 0.0)
+        except (AttributeError, IndexError, KeyError, ValueError):
+            raise ValueError("G_format must be a template taking the command, X, Y and Z")
+        plan["G_format"] = G_format
+
+    if "M104_P_support" in rules:
+        if not isinstance(rules["M104_P_support"], bool):
+            raise ValueError("M104_P_support must be true or false")
+        plan["M104_P_support"] = rules["M104_P_support"]
+
+    if "gcode_M240_param" in rules:
+        params = rules["gcode_M240_param"]
+        if not isinstance(params, dict) or not all(isinstance(value, int) and not isinstance(value, bool) for value in params.values()):
+            raise ValueError("gcode_M240_param must map materials to whole numbers")
+        plan["gcode_M240_param"] = dict(params)
+
+    if "chamber_temperature" in rules:
+        plan["chamber_temperature"] = _compileChamberTemperature(rules["chamber_temperature"])
+
+    return plan
+
+
+def _compileChamberTemperature(rule: Optional[Dict]) -> Optional[Dict[str, bytes]]:
+    if rule is None:
+        return None
+    if not isinstance(rule, dict) or not {"set", "command"} <= set(rule) <= {"set", "wait", "command"} \
+            or not all(isinstance(command, str) and command for command in rule.values()):
+        raise ValueError("chamber_temperature must name the set, optionally the wait, and the replacement commands")
+    return {name: command.encode("ascii") for name, command in rule.items()}
@@ -0,0 +1,56 @@
+####################################################################
+#  WorkerPool for the CubeproWriter plugin
+#
+#  Starts the worker processes ParallelEncryptor and ParallelTranslator
+#  hand their chunks to, and takes the results back from them. Cura
+#  imports its plugins from their directories without putting them on
+#  the module search path, so a freshly spawned worker couldn't import
+#  this package to unpickle its tasks and the task would be lost. Each
+#  worker adds the directory the package was imported from to its path
+#  before taking any task, and no result is waited for longer than a
+#  time limit so that a pool which stops working can't hang the export.
+#
+#  Written by mirdoc
+#
+#  This plugin is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+####################################################################
+
+import multiprocessing
+import multiprocessing.pool
+import os
+import site
+
+from typing import Callable, Iterator, Optional, Sequence
+
+# The directory this package is imported from, found by going up one directory for each level of the module name
+_package_root = os.path.abspath(__file__)
+for _level in range(__name__.count(".") + 1):
+    _package_root = os.path.dirname(_package_root)
+
+# The longest time in seconds to wait for a chunk, which covers starting the workers and a chunk of the slowest cipher
+# backend with plenty to spare
+result_timeout = 60.0
+
+
+######################################################################
+##  Starts a pool of worker processes. Spawned rather than forked,
+##  since forking a multithreaded Qt application is not safe.
+######################################################################
+def createPool(workers: int) -> multiprocessing.pool.Pool:
+    # The initializer has to be importable by the workers before they can import anything of this package
+    return multiprocessing.get_context("spawn").Pool(workers, initializer = site.addsitedir, initargs = (_package_root,))
+
+
+######################################################################
+##  Yields the result of function for each task in order, as imap does.
+##  Raises multiprocessing.TimeoutError if a result takes longer than
+##  timeout seconds, result_timeout unless given.
+######################################################################
+def imapWithTimeout(pool: multiprocessing.pool.Pool, function: Callable, tasks: Sequence, timeout: Optional[float] = None) -> Iterator:
+    if timeout is None:
+        timeout = result_timeout
+    results = pool.imap(function, tasks)
+    for _ in range(len(tasks)):
+        yield results.next(timeout)
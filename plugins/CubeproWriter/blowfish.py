@@ -29,6 +29,23 @@ Send questions, comments, bugs my way:
 
 __author__ = "Michael Gilfix <mgilfix@eecs.tufts.edu>"
 
+import sys
+
+from array import array
+
+# NumPy is optional. When it is available whole buffers are processed
+# by the vectorised engine, otherwise by the pure python array engine.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Typecode of an unsigned 32-bit array item
+_WORD_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
+# Creates the bulk engine of a Blowfish instance, see set_engine_factory()
+_engine_factory = None
+
 class Blowfish:
 
     """Blowfish encryption Scheme
@@ -41,6 +58,14 @@ class Blowfish:
             length ranging from 8 to 56 bytes (64 to 448
             bits). Once the instance of the object is
             created, the key is no longer necessary.
+        def from_schedule (cls, p_boxes, s_boxes, key=None)
+            Creates an instance from a previously derived
+            key schedule as returned by schedule(), skipping
+            the expensive key setup. 'key' is optional and
+            only needed by native bulk engines.
+        def schedule (self)
+            Returns a copy of the derived P-array and
+            S-boxes as a tuple (p_boxes, s_boxes).
         def encrypt (self, data):
             Encrypt an 8 byte (64-bit) block of text
             where 'data' is an 8 byte string. Returns an
@@ -49,6 +74,18 @@ class Blowfish:
             Decrypt an 8 byte (64-bit) encrypted block
             of text, where 'data' is the 8 byte encrypted
             string. Returns an 8-byte string of plaintext.
+        def encrypt_blocks (self, data):
+            Encrypt a buffer of any multiple of 8 bytes in
+            ECB mode. Returns the encrypted bytes.
+        def decrypt_blocks (self, data):
+            Decrypt a buffer of any multiple of 8 bytes in
+            ECB mode. Returns the decrypted bytes.
+        def engine (self):
+            Returns the bulk engine used by encrypt_blocks
+            and decrypt_blocks. This is created by the
+            factory installed with set_engine_factory(),
+            or else is a NumpyEngine when NumPy is available
+            and an ArrayEngine otherwise.
         def cipher (self, xl, xr, direction):
             Encrypts a 64-bit block of data where xl is
             the upper 32-bits and xr is the lower 32-bits.
@@ -77,6 +114,9 @@ class Blowfish:
         if not key or len(key) < 8 or len(key) > 56:
             raise RuntimeError("Attempted to initialize Blowfish cipher with key of invalid length: %s" %len(key))
 
+        # Kept for bulk engines backed by a native library, which do their own key setup
+        self.key = bytes(key)
+
         self.p_boxes = [
             0x243F6A88, 0x85A308D3, 0x13198A2E, 0x03707344,
             0xA4093822, 0x299F31D0, 0x082EFA98, 0xEC4E6C89,
@@ -381,6 +421,21 @@ class Blowfish:
                 self.s_boxes[i][j] = l
                 self.s_boxes[i][j + 1] = r
 
+    @classmethod
+    def from_schedule (cls, p_boxes, s_boxes, key=None):
+
+        if len(p_boxes) != 18 or len(s_boxes) != 4 or any(len(s_box) != 256 for s_box in s_boxes):
+            raise RuntimeError("Attempted to initialize Blowfish cipher with an invalid key schedule")
+
+        cipher = cls.__new__(cls)
+        cipher.key = key
+        cipher.p_boxes = list(p_boxes)
+        cipher.s_boxes = [list(s_box) for s_box in s_boxes]
+        return cipher
+
+    def schedule (self):
+        return list(self.p_boxes), [list(s_box) for s_box in self.s_boxes]
+
     def cipher (self, xl, xr, direction):
 
         if direction == self.ENCRYPT:
@@ -457,6 +512,35 @@ class Blowfish:
 
         return result
 
+    def encrypt_blocks(self, data, compatibility_mode=False):
+        return self.__cipher_blocks(data, self.ENCRYPT, compatibility_mode)
+
+    def decrypt_blocks(self, data, compatibility_mode=False):
+        return self.__cipher_blocks(data, self.DECRYPT, compatibility_mode)
+
+    def __cipher_blocks(self, data, direction, compatibility_mode):
+
+        if len(data) % 8:
+            raise RuntimeError("Attempted to process data of invalid length: %s" %len(data))
+
+        engine = self.engine()
+        if direction == self.ENCRYPT:
+            return engine.encrypt_blocks(data, compatibility_mode)
+        return engine.decrypt_blocks(data, compatibility_mode)
+
+    def engine(self):
+        # The bulk engine is created on first use from the finished key schedule
+        engine = getattr(self, "_engine", None)
+        if engine is None:
+            if _engine_factory is not None:
+                engine = _engine_factory(self)
+            elif numpy is not None:
+                engine = NumpyEngine(self.p_boxes, self.s_boxes)
+            else:
+                engine = ArrayEngine(self.p_boxes, self.s_boxes)
+            self._engine = engine
+        return engine
+
     def blocksize(self):
         return 8
 
@@ -466,6 +550,203 @@ class Blowfish:
     def key_bits(self):
         return 56 * 8
 
+class NumpyEngine:
+
+    """Vectorised Blowfish ECB engine
+    Processes whole buffers with NumPy lookup table gathers on the
+    S-boxes. uint32 arithmetic wraps around so no modulus operations
+    are needed.
+    """
+
+    # Number of 8 byte blocks processed per pass. This bounds the size
+    # of the temporary arrays.
+    chunk_blocks = 1 << 17
+
+    def __init__(self, p_boxes, s_boxes):
+        self.p_boxes = numpy.array(p_boxes, dtype=numpy.uint32)
+        self.s_boxes = [numpy.array(s_box, dtype=numpy.uint32) for s_box in s_boxes]
+
+    def encrypt_blocks(self, data, compatibility_mode=False):
+        return self.__process(data, compatibility_mode, range(16), 16, 17)
+
+    def decrypt_blocks(self, data, compatibility_mode=False):
+        return self.__process(data, compatibility_mode, range(17, 1, -1), 1, 0)
+
+    def __process(self, data, compatibility_mode, rounds, last_r, last_l):
+        # Same byte order handling as Blowfish.encrypt()
+        if compatibility_mode:
+            dtype = "<u4"
+        else:
+            dtype = ">u4"
+
+        words = numpy.frombuffer(data, dtype=dtype)
+        result = numpy.empty(len(words), dtype=dtype)
+        step = self.chunk_blocks * 2
+
+        p = self.p_boxes
+        s0, s1, s2, s3 = self.s_boxes
+
+        for start in range(0, len(words), step):
+            chunk = words[start:start + step]
+            xl = chunk[0::2].astype(numpy.uint32)
+            xr = chunk[1::2].astype(numpy.uint32)
+            for i in rounds:
+                xl ^= p[i]
+                xr ^= ((s0[xl >> 24] + s1[(xl >> 16) & 0xFF]) ^ s2[(xl >> 8) & 0xFF]) + s3[xl & 0xFF]
+                xl, xr = xr, xl
+            # The halves are left swapped after the last round
+            result[start:start + step:2] = xr ^ p[last_l]
+            result[start + 1:start + step:2] = xl ^ p[last_r]
+
+        return result.tobytes()
+
+
+class ArrayEngine:
+
+    """Pure python Blowfish ECB engine
+    Used when NumPy is not available. The P-array and S-boxes are kept
+    in flat array('I') tables, the whole buffer is converted to 32-bit
+    words in one go and the 16 rounds are unrolled with the P-array
+    entries bound to locals, so no objects are built per round.
+    """
+
+    def __init__(self, p_boxes, s_boxes):
+        self.p_boxes = array(_WORD_TYPECODE, p_boxes)
+        self.s_boxes = array(_WORD_TYPECODE)
+        for s_box in s_boxes:
+            self.s_boxes.extend(s_box)
+
+    def encrypt_blocks(self, data, compatibility_mode=False):
+        words = self.__load(data, compatibility_mode)
+        p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, p17 = self.p_boxes
+        s0, s1, s2, s3 = self.__sbox_lists()
+
+        for i in range(0, len(words), 2):
+            l = words[i]
+            r = words[i + 1]
+            l ^= p0
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p1
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p2
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p3
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p4
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p5
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p6
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p7
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p8
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p9
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p10
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p11
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p12
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p13
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p14
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p15
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            words[i] = r ^ p17
+            words[i + 1] = l ^ p16
+
+        return self.__store(words, compatibility_mode)
+
+    def decrypt_blocks(self, data, compatibility_mode=False):
+        words = self.__load(data, compatibility_mode)
+        p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, p17 = self.p_boxes
+        s0, s1, s2, s3 = self.__sbox_lists()
+
+        for i in range(0, len(words), 2):
+            l = words[i]
+            r = words[i + 1]
+            l ^= p17
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p16
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p15
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p14
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p13
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p12
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p11
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p10
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p9
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p8
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p7
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p6
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p5
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p4
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            l ^= p3
+            r ^= (((s0[l >> 24] + s1[l >> 16 & 0xFF]) ^ s2[l >> 8 & 0xFF]) + s3[l & 0xFF]) & 0xFFFFFFFF
+            r ^= p2
+            l ^= (((s0[r >> 24] + s1[r >> 16 & 0xFF]) ^ s2[r >> 8 & 0xFF]) + s3[r & 0xFF]) & 0xFFFFFFFF
+            words[i] = r ^ p0
+            words[i + 1] = l ^ p1
+
+        return self.__store(words, compatibility_mode)
+
+    def __sbox_lists(self):
+        # Indexing a list returns an existing int object whereas indexing
+        # an array has to box a new one, so the inner loop works on lists
+        s_boxes = self.s_boxes
+        return s_boxes[0:256].tolist(), s_boxes[256:512].tolist(), s_boxes[512:768].tolist(), s_boxes[768:1024].tolist()
+
+    @staticmethod
+    def __load(data, compatibility_mode):
+        words = array(_WORD_TYPECODE)
+        words.frombytes(data)
+        if _swap_needed(compatibility_mode):
+            words.byteswap()
+        return words
+
+    @staticmethod
+    def __store(words, compatibility_mode):
+        if _swap_needed(compatibility_mode):
+            words.byteswap()
+        return words.tobytes()
+
+
+def set_engine_factory(factory):
+    """Installs a callable taking a Blowfish instance and returning the
+    engine used for its bulk functions. None restores the default."""
+    global _engine_factory
+    _engine_factory = factory
+
+def swap_words(data):
+    """Returns data with the byte order of every 32-bit word reversed"""
+    words = array(_WORD_TYPECODE)
+    words.frombytes(data)
+    words.byteswap()
+    return words.tobytes()
+
+def _swap_needed(compatibility_mode):
+    # Compatibility mode works on little endian words, otherwise big endian
+    if compatibility_mode:
+        return sys.byteorder != "little"
+    return sys.byteorder != "big"
+
+
 ##############################################################
 # Module testing
 
@@ -489,3 +770,16 @@ if __name__ == '__main__':
     print("\tEncrypted: %s " %crypted)
     decrypted = cipher.decrypt (crypted, True)
     print("\tDecrypted: %s " %decrypted)
+
+    print("Testing key schedule:")
+    copied = Blowfish.from_schedule (*cipher.schedule ())
+    print("\tMatches: %s" %(copied.encrypt (text, True) == cipher.encrypt (text, True)))
+
+    print("Testing bulk encrypt:")
+    text = b'^Firmware:V1.03A\r\n^Minfirmware:V1.00\r\n\x02\x02'
+    print("\tText: %s" %text)
+    crypted = cipher.encrypt_blocks (text, True)
+    print("\tEncrypted: %s " %crypted)
+    print("\tMatches single block: %s" %(crypted == b''.join(cipher.encrypt (text[i:i + 8], True) for i in range(0, len(text), 8))))
+    decrypted = cipher.decrypt_blocks (crypted, True)
+    print("\tDecrypted: %s " %decrypted)
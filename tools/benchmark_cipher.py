@@ -0,0 +1,203 @@
+#####################################################################
+#  benchmark_cipher.py
+#####################################################################
+#  python script to benchmark the Blowfish implementation used by the
+#  print file writers, and to catch changes which make exports slower.
+#
+#  Measures key schedule setup time, single block encrypt/decrypt
+#  latency, and bulk ECB throughput for every available cipher backend
+#  in both byte orders. Runs without Cura or Qt and prints the results
+#  as JSON.
+#
+#  Usage:
+#    python benchmark_cipher.py [--sizes 1,64,512] [--output results.json]
+#                               [--save-baseline baseline.json]
+#                               [--baseline baseline.json] [--tolerance 0.15]
+#
+#  With --baseline the script exits with status 1 if any bulk
+#  throughput has dropped, or any key setup or single block time has
+#  risen, by more than the tolerance (a fraction) compared to the
+#  stored baseline.
+#
+#  Written by mirdoc
+#
+#  This source is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+#####################################################################
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from plugin_import import import_plugin_module
+
+blowfish = import_plugin_module('blowfish')
+CipherBackends = import_plugin_module('CipherBackends')
+
+# The keys used by the Cube print file formats
+KEYS = [b'221BBakerMycroft', b'kWd$qG*25Xmgf-Sg']
+
+MB = 1000 * 1000
+
+
+def median_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def benchmark_key_setup(repeat):
+    results = {}
+    for key in KEYS:
+        cipher = blowfish.Blowfish(key)
+        schedule = cipher.schedule()
+        results[key.decode('ascii')] = {
+            'derive_ms': median_time(lambda: blowfish.Blowfish(key), repeat) * 1000,
+            'from_schedule_ms': median_time(lambda: blowfish.Blowfish.from_schedule(*schedule, key = key), repeat) * 1000
+        }
+    return results
+
+
+def benchmark_single_block(repeat):
+    cipher = blowfish.Blowfish(KEYS[0])
+    block = b'^Firmwar'
+    encrypted = cipher.encrypt(block, True)
+    loops = 1000
+    return {
+        'encrypt_us': median_time(lambda: [cipher.encrypt(block, True) for i in range(loops)], repeat) / loops * 1e6,
+        'decrypt_us': median_time(lambda: [cipher.decrypt(encrypted, True) for i in range(loops)], repeat) / loops * 1e6
+    }
+
+
+def benchmark_bulk(sizes_mb, time_budget):
+    cipher = blowfish.Blowfish(KEYS[0])
+    registry = CipherBackends.createDefaultRegistry()
+
+    largest = max(sizes_mb) * MB
+    data = memoryview(os.urandom(largest - largest % 8))
+
+    results = {}
+    for backend in registry.getBackends():
+        try:
+            if registry.selfTest(backend) is None:
+                results[backend.name] = {'status': 'failed known-answer test'}
+                continue
+            engine = backend.factory(cipher)
+        except ImportError as e:
+            results[backend.name] = {'status': 'not available: ' + str(e)}
+            continue
+        except Exception as e:
+            results[backend.name] = {'status': 'self-test error: ' + repr(e)}
+            continue
+
+        backend_results = {'status': 'ok'}
+        for byte_order, compatibility_mode in (('little', True), ('big', False)):
+            rate = None
+            for size_mb in sorted(sizes_mb):
+                key = '%s_%dMB' % (byte_order, size_mb)
+                size = size_mb * MB - size_mb * MB % 8
+
+                # Skip sizes that would take too long going by the throughput of the previous size
+                if rate is not None and size / (rate * MB) > time_budget:
+                    backend_results[key] = None
+                    continue
+
+                # Quick measurements are repeated and the best kept to reduce noise
+                elapsed = None
+                for run in range(3):
+                    start = time.perf_counter()
+                    engine.encrypt_blocks(data[:size], compatibility_mode)
+                    run_time = max(time.perf_counter() - start, 1e-9)
+                    elapsed = run_time if elapsed is None else min(elapsed, run_time)
+                    if elapsed > 1:
+                        break
+                rate = size / MB / elapsed
+                backend_results[key] = rate
+
+        results[backend.name] = backend_results
+    return results
+
+
+def find_time_regressions(current, baseline, tolerance, name, regressions):
+    # Times are nested dicts of measurements, and a time is a regression when it got longer
+    for key, baseline_value in baseline.items():
+        value = current.get(key) if isinstance(current, dict) else None
+        if isinstance(baseline_value, dict):
+            find_time_regressions(value, baseline_value, tolerance, name + '.' + key, regressions)
+        elif baseline_value and value is not None and value > baseline_value * (1 + tolerance):
+            regressions.append({'measurement': name + '.' + key, 'baseline': baseline_value, 'current': value})
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name in ('key_setup', 'single_block'):
+        find_time_regressions(results[name], baseline.get(name, {}), tolerance, name, regressions)
+
+    for backend, measurements in baseline.get('bulk_mb_per_s', {}).items():
+        current = results['bulk_mb_per_s'].get(backend, {})
+        for key, baseline_rate in measurements.items():
+            if key == 'status' or not baseline_rate:
+                continue
+            rate = current.get(key)
+            if rate is None:
+                continue
+            if rate < baseline_rate * (1 - tolerance):
+                regressions.append({'backend': backend, 'measurement': key, 'baseline': baseline_rate, 'current': rate})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the Blowfish implementation used by the Cube print file writers.')
+    parser.add_argument('--sizes', default = '1,64,512', help = 'comma separated bulk buffer sizes in MB (default 1,64,512)')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'repetitions for the timing of small operations')
+    parser.add_argument('--time-budget', type = float, default = 60, help = 'skip bulk sizes expected to take longer than this many seconds')
+    parser.add_argument('--output', help = 'write the results to this file as well as stdout')
+    parser.add_argument('--save-baseline', help = 'store the results as a baseline for later runs')
+    parser.add_argument('--baseline', help = 'compare the results against this baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.15, help = 'allowed throughput drop or time increase as a fraction of the baseline (default 0.15)')
+    args = parser.parse_args()
+
+    sizes_mb = [int(size) for size in args.sizes.split(',') if size]
+
+    results = {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'numpy': getattr(blowfish.numpy, '__version__', None),
+        'key_setup': benchmark_key_setup(args.repeat),
+        'single_block': benchmark_single_block(args.repeat),
+        'bulk_mb_per_s': benchmark_bulk(sizes_mb, args.time_budget)
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        results['tolerance'] = args.tolerance
+        results['regressions'] = find_regressions(results, baseline, args.tolerance)
+        if results['regressions']:
+            exit_code = 1
+
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    print(output)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(output + '\n')
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#####################################################################
+#  patch_header.py
+#####################################################################
+#  python script to show or change the header fields of existing
+#  .cube, .cube3, .cubex and .cubepro print files, for example to swap
+#  the filament colour or fix the print time without re-slicing.
+#
+#  Usage:
+#    python patch_header.py --show job.cubepro
+#    python patch_header.py --set MaterialCodeE1=209 --set Time=95 *.cubepro
+#    python patch_header.py --set MaterialCodeE1=259 --output-dir out job.cubepro
+#
+#  Fields are named as they appear in the file without the leading ^.
+#  Files are changed in place unless --output-dir is given.
+#
+#  Written by mirdoc
+#
+#  This source is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+#####################################################################
+
+import argparse
+import glob
+import os
+import sys
+
+from plugin_import import import_plugin_module
+
+HeaderPatcher = import_plugin_module('HeaderPatcher').HeaderPatcher
+KeyScheduleCache = import_plugin_module('KeyScheduleCache').KeyScheduleCache
+
+
+def parse_fields(assignments):
+    fields = {}
+    for assignment in assignments:
+        name, separator, value = assignment.partition('=')
+        if not separator or not name:
+            raise ValueError('Expected NAME=VALUE, got: ' + assignment)
+        fields[name.lstrip('^')] = value
+    return fields
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Show or change the header fields of encrypted Cube print files.')
+    parser.add_argument('files', nargs = '+', help = 'print files, wildcards are expanded')
+    parser.add_argument('--set', action = 'append', default = [], metavar = 'NAME=VALUE', help = 'header field to change, may be repeated')
+    parser.add_argument('--show', action = 'store_true', help = 'print the header fields')
+    parser.add_argument('--output-dir', help = 'write changed files to this directory instead of changing them in place')
+    args = parser.parse_args()
+
+    fields = parse_fields(args.set)
+    key_schedule_cache = KeyScheduleCache()
+
+    paths = []
+    for pattern in args.files:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok = True)
+
+    failures = 0
+    for path in paths:
+        try:
+            patcher = HeaderPatcher.forFile(path, key_schedule_cache)
+
+            if fields:
+                output_path = os.path.join(args.output_dir, os.path.basename(path)) if args.output_dir else None
+                blocks = patcher.patchFile(path, fields, output_path)
+                print('%s: re-encrypted %d blocks' % (output_path or path, blocks))
+
+            if args.show:
+                with open(os.path.join(args.output_dir, os.path.basename(path)) if args.output_dir and fields else path, 'rb') as f:
+                    print(path)
+                    for name, value in patcher.getFields(patcher.readHeader(f)):
+                        print('  ^%s:%s' % (name, value))
+        except (OSError, ValueError, KeyError) as e:
+            print('%s: %s' % (path, e), file = sys.stderr)
+            failures += 1
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,32 @@
+#####################################################################
+#  plugin_import.py
+#####################################################################
+#  Helper for the tools in this directory to import the Cura
+#  independent modules of the CubeproWriter plugin (the cipher and
+#  g-code translation code) without Cura or Qt being installed.
+#
+#  The plugin package's __init__.py imports Cura, so an empty package
+#  object pointing at the plugin directory is registered in its place.
+#
+#  Written by mirdoc
+#
+#  This source is released under the terms of the LGPLv3 or higher.
+#  The full text of the LGPLv3 License can be found here:
+#  https://github.com/mirdoc/Cura-CubePrinterPlugin/blob/master/LICENSE
+#####################################################################
+
+import importlib
+import os
+import sys
+import types
+
+PLUGIN_NAME = 'CubeproWriter'
+PLUGIN_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'plugins', PLUGIN_NAME))
+
+
+def import_plugin_module(module_name):
+    if PLUGIN_NAME not in sys.modules:
+        package = types.ModuleType(PLUGIN_NAME)
+        package.__path__ = [PLUGIN_DIR]
+        sys.modules[PLUGIN_NAME] = package
+    return importlib.import_module(PLUGIN_NAME + '.' + module_name)